@@ -0,0 +1,183 @@
+'''
+Benchmarks for the hot paths of uri_template and described_routes, printing their results as JSON.
+
+Usage:
+
+$ python benchmarks.py [--sizes 10,100,1000] [--output results.json] [--compare previous.json]
+
+Each timing is the best of --repeat runs of enough calls to take at least --min-time seconds, reported in seconds
+per call.  Trees are synthetic (see synthetic_data()) and deterministic, so results from different releases or
+machines can be compared with --compare, which prints the ratio of each timing to its previous value.
+'''
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+
+import described_routes
+import uri_template
+
+def synthetic_data(n, fanout=4):
+    """
+    Returns a tree of n resource template dicts, breadth first with the given fanout, in the style of a typical
+    application description: each level adds a param to those of its parent
+    """
+    roots = []
+    parents = collections.deque()
+    for i in range(n):
+        if parents:
+            parent = parents[0]
+            siblings = parent.setdefault('resource_templates', [])
+            if len(siblings) == fanout - 1:
+                parents.popleft()
+            path = parent['path_template'][:-len('{-prefix|.|format}')]
+            params = parent['params']
+        else:
+            siblings = roots
+            path = ''
+            params = []
+        param = 'id_%d' % len(params)
+        d = {
+            'name':            'resource_%d' % i,
+            'rel':             'rel_%d' % (i % fanout),
+            'uri_template':    'http://example.com%s/r%d/{%s}{-prefix|.|format}' % (path, i, param),
+            'path_template':   '%s/r%d/{%s}{-prefix|.|format}' % (path, i, param),
+            'params':          params + [param],
+            'optional_params': ['format'],
+            'options':         ['GET', 'PUT', 'DELETE']}
+        siblings.append(d)
+        parents.append(d)
+    return roots
+
+def synthetic_tree(n, fanout=4):
+    return described_routes.ResourceTemplates(synthetic_data(n, fanout))
+
+def bench_memory(n):
+    """
+    Memory per node of a tree of n templates, before and after its templates are compiled (by partial expansion), and
+    of the partially expanded tree
+    """
+    tree = synthetic_tree(n)
+    result = {'nodes': n, 'bytes_per_node': described_routes.deep_sizeof(tree) / float(n)}
+    expanded = tree.partial_expand({'id_0': '1'})
+    result['compiled_bytes_per_node'] = described_routes.deep_sizeof(tree) / float(n)
+    result['expanded_bytes_per_node'] = described_routes.deep_sizeof(expanded) / float(n)
+    return result
+
+def measure(func, min_time=0.2, repeat=3):
+    """
+    Returns (seconds per call, calls per run) for the best of repeat runs of func
+    """
+    calls = 1
+    while True:
+        start = time.time()
+        for _ in xrange(calls):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time or calls >= 1 << 24:
+            break
+        calls *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in xrange(calls):
+            func()
+        best = min(best, time.time() - start)
+    return best / calls, calls
+
+# Templates for uri_template.sub(), one per operator, with params for full and partial expansion
+OPERATOR_CASES = [
+    ('variable', '/users/{user_id}',                       {'user_id': 'dojo'},                 {}),
+    ('opt',      '/search{-opt|?|q,num}',                  {'q': 'fish'},                       {}),
+    ('neg',      '/search{-neg|all|q,num}',                {'q': 'fish'},                       {}),
+    ('prefix',   '/users/dojo{-prefix|.|format}',          {'format': 'json'},                  {}),
+    ('suffix',   '/{-suffix|/|user_id}articles',           {'user_id': 'dojo'},                 {}),
+    ('join',     '/search?{-join|&|q,num,page}',           {'q': 'fish', 'num': '10'},          {'num': '10'}),
+    ('list',     '/files/{-list|/|parts}',                 {'parts': ['a', 'b', 'c']},          {})]
+
+def bench_operators(min_time, repeat):
+    results = []
+    for operator, template, params, partial_params in OPERATOR_CASES:
+        for mode, p, partial in (('full', params, False), ('partial', partial_params, True)):
+            seconds, calls = measure(lambda: uri_template.sub(template, p, partial=partial), min_time, repeat)
+            results.append({'benchmark': 'sub', 'operator': operator, 'mode': mode, 'seconds': seconds, 'calls': calls})
+    return results
+
+def bench_tree(n, min_time, repeat):
+    """
+    Timings of the main ResourceTemplate and ResourceTemplates operations on a tree of n templates
+    """
+    tree = synthetic_tree(n)
+    deepest = list(tree._walk())[-1]
+    params = dict((p, '1') for p in deepest.params)
+    params['format'] = 'json'
+    index = tree.get_index()
+
+    benchmarks = [
+        ('uri_for',        lambda: deepest.uri_for(params)),
+        ('path_for',       lambda: deepest.path_for(params)),
+        ('partial_expand', lambda: tree.partial_expand({'id_0': '1'})),
+        ('all_by_name',    lambda: tree.all_by_name()),
+        ('find_by_name',   lambda: tree.find_by_name(deepest.name)),
+        ('index_build',    lambda: index.rebuild()),
+        ('to_dict',        lambda: [rt.to_dict() for rt in tree]),
+        ('str',            lambda: str(tree))]
+
+    results = []
+    for name, func in benchmarks:
+        seconds, calls = measure(func, min_time, repeat)
+        results.append({'benchmark': name, 'nodes': n, 'seconds': seconds, 'calls': calls})
+    return results
+
+def run(sizes, min_time=0.2, repeat=3):
+    return {
+        'meta': {
+            'python':    platform.python_version(),
+            'platform':  platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+        'timings':   bench_operators(min_time, repeat) + sum([bench_tree(n, min_time, repeat) for n in sizes], []),
+        'memory':    [bench_memory(n) for n in sizes]}
+
+def result_key(result):
+    return tuple((k, result[k]) for k in sorted(result) if k not in ('seconds', 'calls'))
+
+def compare(previous, current):
+    """
+    Returns a list of (benchmark description, previous seconds, current seconds, ratio) for the timings in both
+    """
+    previous_timings = dict((result_key(r), r['seconds']) for r in previous['timings'])
+    comparison = []
+    for r in current['timings']:
+        key = result_key(r)
+        if key in previous_timings:
+            before = previous_timings[key]
+            comparison.append((' '.join('%s=%s' % kv for kv in key), before, r['seconds'], r['seconds'] / before))
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark uri_template and described_routes')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma-separated node counts of the synthetic trees')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per benchmark')
+    parser.add_argument('--output', help='file for the JSON results (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = run([int(n) for n in args.sizes.split(',')], args.min_time, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for description, before, after, ratio in compare(previous, results):
+            sys.stderr.write('%-60s %12.3gs %12.3gs %6.2fx\n' % (description, before, after, ratio))
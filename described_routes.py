@@ -1,5 +1,24 @@
+import collections
+import itertools
+import json
+import mmap
+import multiprocessing
+import re
+import struct
+import sys
+import urllib
+import urlparse
+from xml.sax.saxutils import escape
+
 import uri_template
 
+ATTRIBUTES = ('name', 'rel', 'uri_template', 'path_template', 'params', 'optional_params', 'options')
+
+# For the cooperative variants of ResourceTemplates operations (see cooperatively()): templates processed between
+# pauses, and the size of tree above which work is offloaded to an executor if given
+COOPERATIVE_STEP = 100
+OFFLOAD_THRESHOLD = 10000
+
 class ResourceTemplate(object):
     """
     Dynamic, framework-neutral metadata describing path/URI structures natively in Python and through
@@ -11,6 +30,10 @@ class ResourceTemplate(object):
     it aims to cover a spectrum ranging from application description languages (cf WSDL and WADL) through to
     more dynamic, hyperlinked interaction (cf REST and HATEOAS).
     """
+    __slots__ = ('_name', '_rel', '_uri_template', '_path_template', '_params', '_optional_params', '_options',
+                 '_children', 'parent', '_compiled_uri_template', '_compiled_path_template', '_partial_expansions',
+                 '_param_set', '_optional_param_set', '_inherited', '_static', '_collection')
+
     def __init__(self, d={}, parent=None, **kwargs):
         """
         Initialize a ResourceTemplate from a dict &/or keyword arguments, all of which are optional.  For example:
@@ -28,50 +51,253 @@ class ResourceTemplate(object):
         ...                     resource_templates = [user_article, new_user_article])
 
         The resource_templates parameter can be a ResourceTemplates object, an array of ResourceTemplate objects
-        or an array of hashes.  This last option makes it easy to initialize a whole hierarchy directly from deserialised JSON or YAML
-        objects, e.g.:
+        or an array of hashes.  This last option makes it easy to initialize a whole hierarchy directly from
+        deserialised JSON or YAML objects, e.g.:
 
         >>> user_articles = ResourceTemplate(JSON.parse(json))
         >>> user_articles = ResourceTemplate(YAML.load(yaml))
+
+        The params, optional_params and options attributes are stored as tuples, shared with every other template
+        having the same values, as are the name and rel strings (see Vocabulary).  Templates without
+        resource_templates share a single empty ResourceTemplates object until theirs is accessed.
         """
         if d:
             if not isinstance(d, dict):
                 raise TypeError(repr(d) + " is not a dict")
             if kwargs:
-                d = d.clone
+                d = dict(d)
                 d.update(kwargs)
         else:
             d = kwargs
 
+        self._collection = None
+        self._partial_expansions = None
         for attr in ('name', 'rel', 'uri_template', 'path_template'):
             setattr(self, attr, d.get(attr))
-        
+
         for attr in ('params', 'optional_params', 'options'):
-            setattr(self, attr, d.get(attr, []))
+            setattr(self, attr, d.get(attr, ()))
 
-        self.resource_templates = ResourceTemplates(d.get('resource_templates', []), parent)
         self.parent = parent
+        resource_templates = d.get('resource_templates')
+        self._children = ResourceTemplates(resource_templates, self) if resource_templates else EMPTY
+        self._compiled_uri_template = self._compiled_path_template = None
+        self._static = _static_links(self)
+
+    def _touch(self):
+        """
+        Invalidate what's derived from this template and from the collections containing it, after a change to its
+        attributes
+        """
+        if self._partial_expansions is not None:
+            self._partial_expansions.invalidate()
+        if self._collection is not None:
+            self._collection._touch()
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = vocabulary.string(name)
+        self._touch()
+
+    @property
+    def rel(self):
+        return self._rel
+
+    @rel.setter
+    def rel(self, rel):
+        self._rel = vocabulary.string(rel)
+        self._touch()
+
+    @property
+    def uri_template(self):
+        return self._uri_template
+
+    @uri_template.setter
+    def uri_template(self, uri_template):
+        self._uri_template = uri_template
+        self._touch()
+
+    @property
+    def path_template(self):
+        return self._path_template
+
+    @path_template.setter
+    def path_template(self, path_template):
+        self._path_template = path_template
+        self._touch()
+
+    @property
+    def params(self):
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = vocabulary.strings(params)
+        self._param_set = vocabulary.string_set(self._params)
+        self._inherited = None
+        self._touch()
+
+    @property
+    def optional_params(self):
+        return self._optional_params
+
+    @optional_params.setter
+    def optional_params(self, optional_params):
+        self._optional_params = vocabulary.strings(optional_params)
+        self._optional_param_set = vocabulary.string_set(self._optional_params)
+        self._inherited = None
+        self._touch()
+
+    @property
+    def param_set(self):
+        """
+        The params, as a frozenset
+        """
+        return self._param_set
+
+    @property
+    def optional_param_set(self):
+        """
+        The optional_params, as a frozenset
+        """
+        return self._optional_param_set
+
+    @property
+    def inherited_param_set(self):
+        """
+        The frozenset of params and optional_params that are also params of the parent, cached until either side's
+        params change
+        """
+        parent = self.parent
+        if parent is None:
+            return frozenset()
+        inherited = self._inherited
+        if inherited is None or inherited[0] is not parent.param_set:
+            inherited = self._inherited = (parent.param_set,
+                                           (self._param_set | self._optional_param_set) & parent.param_set)
+        return inherited[1]
+
+    @property
+    def options(self):
+        return self._options
+
+    @options.setter
+    def options(self, options):
+        self._options = vocabulary.strings(options)
+        self._touch()
+
+    @property
+    def resource_templates(self):
+        """
+        The ResourceTemplates collection of this template's children, created on first access for a template that has
+        none (when it joins the index of the collection containing the template, if any).
+        """
+        children = self._children
+        if children is EMPTY:
+            children = self._children = ResourceTemplates((), self)
+            if self._collection is not None:
+                children._index = self._collection._index
+        return children
+
+    @resource_templates.setter
+    def resource_templates(self, resource_templates):
+        # As with the other changes to a tree: the old children leave its index and the new ones join it, and what's
+        # derived from the tree is invalidated
+        old = self._children
+        if isinstance(resource_templates, ResourceTemplates) and resource_templates:
+            new = resource_templates
+            new.parent = self
+            for rt in new:
+                rt.parent = self
+            new._adopt(new)
+        else:
+            new = ResourceTemplates(resource_templates, self) if resource_templates else EMPTY
+        collection = self._collection
+        index = collection._index if collection is not None else old._index
+        self._children = new
+        if old is not new:
+            old._release(old)
+            if index is not None:
+                for rt in old:
+                    index.detach(rt)
+                old._index = None
+        if index is not None:
+            index.version += 1
+            if index.frozen:
+                index.complete = False
+                for rt in new:
+                    index.attach(rt)
+                if new is not EMPTY:
+                    new._index = index
+            else:
+                index.rebuild()
+        self._touch()
 
     def to_dict(self, base=None):
         """
         Convert to a dict, perhaps for a further conversion to JSON or YAML.
         """
+        d = self._attributes_dict()
+        if self._children: d['resource_templates'] = self._children.to_list()
+        return d
+
+    def structural_hash(self):
+        """
+        A hash of this template's attributes and of its subtree, equal for templates with equal to_dict()
+        representations
+        """
+        return hash((tuple(getattr(self, attr) for attr in ATTRIBUTES), self._children.structural_hash()))
+
+    def _attributes_dict(self):
         d = dict()
-        
-        for attr in ('name', 'rel', 'uri_template', 'path_template', 'params', 'optional_params', 'options'):
+        for attr in ATTRIBUTES:
             val = getattr(self, attr)
-            if val: d[attr] = val
-
-        if self.resource_templates: d['resource_templates'] = self.resource_templates.to_list()
-        
+            if val: d[attr] = list(val) if isinstance(val, tuple) else val
         return d
 
+    def stream(self, format='json'):
+        """
+        Returns a generator of chunks of this template's JSON, YAML or XML representation, walking the tree as it goes
+        rather than building it as a dict first
+        """
+        return serialisers[format][1](self)
+
+    def to_json(self, cache=False):
+        """
+        This template's JSON representation, as a string.  If cache, the JSON of the collections below it is kept for
+        reuse; see ResourceTemplates.to_json().
+        """
+        if cache:
+            return _cached_json_template(self)
+        return ''.join(_json_template(self))
+
+    def write(self, out, format='json'):
+        """
+        Write this template's JSON, YAML or XML representation incrementally to a file-like object
+        """
+        for chunk in self.stream(format):
+            out.write(chunk)
+
     def __str__(self):
         """
         Text report
         """
         return str(ResourceTemplates([self]))
 
+    def __reduce__(self):
+        # Pickled without compiled templates or memoized expansions, lazy and snapshot templates as plain ones
+        cls = ResourceTemplate if isinstance(self, (LazyResourceTemplate, SnapshotResourceTemplate)) else type(self)
+        return cls, (), dict((attr, getattr(self, attr)) for attr in PICKLED_ATTRIBUTES)
+
+    def __setstate__(self, state):
+        for attr, val in state.iteritems():
+            setattr(self, attr, val)
+        self._static = _static_links(self)
+
 
     def positional_params(self, parent):
         """
@@ -80,9 +306,25 @@ class ResourceTemplate(object):
         
         all_params = self.params + self.optional_params
         if parent:
-            return [p for p in all_params if p not in parent.params]
+            excluded = self.inherited_param_set if parent is self.parent else parent.param_set
+            return [p for p in all_params if p not in excluded]
         else:
-            return all_params
+            return list(all_params)
+
+    def has_params(self, actual_params):
+        """
+        Returns True if the given params hash contains all mandatory params
+        """
+        for p in self.params:
+            if p not in actual_params:
+                return False
+        return True
+
+    def missing_params(self, actual_params):
+        """
+        Returns the list of mandatory params missing from the given params hash
+        """
+        return [p for p in self.params if p not in actual_params]
 
 
     def uri_template_for_base(self, base):
@@ -94,158 +336,1858 @@ class ResourceTemplate(object):
         elif base and self.path_template:
             return base + self.path_template
             
-    def uri_for(self, actual_params, base=None):
+    def uri_for(self, actual_params, base=None, encoding=urllib.quote):
         """
-        Returns an expanded URI template with template variables filled from the given params hash.
+        Returns an expanded URI template with template variables filled from the given params hash, encoded with the
+        given encoding function (e.g. one returned by uri_template.quoter()).
         Raises KeyError if params doesn't contain all mandatory params.
         """
-        missing_params = [p for p in self.params if p not in actual_params]
-        if missing_params:
-            raise KeyError('missing params ' + ', '.join(missing_params))
+        instrumentation = uri_template.instrumentation
+        if instrumentation is not None:
+            return instrumentation.call('uri_for', self.name, self._uri_for, (actual_params, base, encoding))
+        return self._uri_for(actual_params, base, encoding)
+
+    def _uri_for(self, actual_params, base, encoding):
+        if self._static is not None:
+            uri = self._static_uri(base)
+            if uri is not None:
+                return uri
+
+        for p in self.params:
+            if p not in actual_params:
+                raise KeyError('missing params ' + ', '.join(self.missing_params(actual_params)))
             
+        return self.expansion_template(base).expand(actual_params, encoding)
+
+    @property
+    def is_static(self):
+        """
+        True if this template's URIs and paths are precomputed, it having no params and its templates no expressions,
+        so that uri_for() and path_for() return them without expansion
+        """
+        static = self._static
+        return (static is not None and static[0] is self.uri_template and static[1] is self.path_template
+                and not self.params)
+
+    def _static_uri(self, base):
+        if not self.is_static:
+            return None
+        uri_template, path_template, uris = self._static
+        if uri_template:
+            return uri_template
+        if not base:
+            return None
+        uri = uris.get(base) if uris else None
+        if uri is None:
+            uri = base + path_template
+            if uris is None:
+                self._static = (uri_template, path_template, {base: uri})
+            elif len(uris) < MAX_STATIC_BASES:
+                uris[base] = uri
+        return uri
+
+    def expansion_template(self, base=None):
+        """
+        Returns the compiled template that uri_for() expands for the given base.
+        Raises RuntimeError if there is none, i.e. there's no uri_template and no base &/or path_template.
+        """
+        if self.uri_template:
+            return self.compiled_template('uri_template')
+
         t = self.uri_template_for_base(base)
         if not t:
             raise RuntimeError('uri_template_for_base(%s) is None; path_template=%s' % (repr(base), repr(self.path_template)))
+
+        return uri_template.cached(t)
+
+    def uris_for(self, param_rows, base=None, encoding=urllib.quote):
+        """
+        Returns a generator of URIs expanded from each of the given params dicts, as per uri_for() but preparing the
+        template just once for the whole batch.
+        Raises RuntimeError straight away if there's no template for the given base, and KeyError from the generator
+        at the first params dict that doesn't contain all mandatory params.
+        """
+        return self._expand_rows(self.expansion_template(base), param_rows, encoding)
+
+    def uris_for_columns(self, columns, base=None, encoding=urllib.quote):
+        """
+        Like uris_for(), but taking a dict of equal-length param sequences (lists, tuples, NumPy arrays etc) keyed by
+        param name, and returning a list of URIs expanded in bulk by uri_template.Template.expand_columns().
+        Raises KeyError if columns doesn't contain all mandatory params, or if any of their values are None (which
+        expand_columns() takes to mean absent).
+        """
+        columns = self._check_columns(columns)
+        return self.expansion_template(base).expand_columns(columns, encoding)
+
+    def paths_for(self, param_rows, encoding=urllib.quote):
+        """
+        Returns a generator of paths expanded from each of the given params dicts, as per path_for() but preparing the
+        template just once for the whole batch
+        """
+        if not self.path_template:
+            raise RuntimeError('path_template is None')
+
+        return self._expand_rows(self.compiled_template('path_template'), param_rows, encoding)
+
+    def _check_columns(self, columns):
+        # Returns the columns as lists or tuples, having converted them to look for Nones
+        if not self.has_params(columns):
+            raise KeyError('missing params ' + ', '.join(self.missing_params(columns)))
+        columns = dict((name, uri_template.column_values(values)) for name, values in columns.iteritems())
+        for p in self.params:
+            if any(value is None for value in columns[p]):
+                raise KeyError('missing values of param ' + p)
+        return columns
+
+    def _expand_rows(self, template, param_rows, encoding):
+        required = self.params
+        expand = template.expand
+        for actual_params in param_rows:
+            for p in required:
+                if p not in actual_params:
+                    raise KeyError('missing params ' + ', '.join(self.missing_params(actual_params)))
+            yield expand(actual_params, encoding)
         
-        return uri_template.sub(t, actual_params)
-        
-    def path_for(self, actual_params):
+    def path_for(self, actual_params, encoding=urllib.quote):
         """
         Returns an expanded path template with template variables filled from the given params hash.
         Raises KeyError if params doesn't contain all mandatory params.
         """
-        missing_params = [p for p in self.params if p not in actual_params]
-        if missing_params:
-            raise KeyError('missing params ' + ', '.join(missing_params))
+        instrumentation = uri_template.instrumentation
+        if instrumentation is not None:
+            return instrumentation.call('path_for', self.name, self._path_for, (actual_params, encoding))
+        return self._path_for(actual_params, encoding)
+
+    def _path_for(self, actual_params, encoding):
+        if self._static is not None and self.path_template and self.is_static:
+            return self.path_template
+
+        for p in self.params:
+            if p not in actual_params:
+                raise KeyError('missing params ' + ', '.join(self.missing_params(actual_params)))
 
         if not self.path_template:
             raise RuntimeError('path_template is None')
 
-        return uri_template.sub(path_template, actual_params)
+        return self.compiled_template('path_template').expand(actual_params, encoding)
+
+    def compiled_template(self, attr):
+        """
+        Returns the named template attribute ('uri_template' or 'path_template') as a uri_template.Template, compiling
+        it on first use, or None if it isn't set
+        """
+        template = getattr(self, attr)
+        if not template:
+            return None
+        slot = COMPILED_SLOTS[attr]
+        compiled = getattr(self, slot)
+        if compiled is None or compiled.template != template:
+            compiled = uri_template.compile(template)
+            setattr(self, slot, compiled)
+        return compiled
     
-    def partial_expand(self, actual_params):
+    def partial_expand(self, actual_params, lazy=False, encoding=urllib.quote):
         """
-        Return a new resource template with the path_template &/or uri_template partially expanded with the given params        
+        Return a new resource template with the path_template &/or uri_template partially expanded with the given params.
+        If lazy, this is a LazyResourceTemplate, expanding its attributes and children only when they are accessed.
         """
-        return type(self)(
+        instrumentation = uri_template.instrumentation
+        if instrumentation is not None:
+            return instrumentation.call('partial_expand', self.name, self._memoized_partial_expand,
+                                        (actual_params, lazy, encoding))
+        return self._memoized_partial_expand(actual_params, lazy, encoding)
+
+    def _memoized_partial_expand(self, actual_params, lazy, encoding):
+        if self._partial_expansions is not None:
+            return self._partial_expansions.lookup(
+                        self._stamp(), actual_params, lazy, encoding, self._partial_expand)
+        return self._partial_expand(actual_params, lazy, encoding)
+
+    def _stamp(self):
+        # The state of this template's subtree, for its memoized partial expansions (changes to the template itself
+        # invalidate them directly; see _touch()), taken without creating or indexing a collection for its children
+        children = self._children
+        collection = self._collection
+        index = collection._index if collection is not None else None
+        return children, children._version, index.epoch if index is not None else None
+
+    def _partial_expand(self, actual_params, lazy, encoding):
+        if lazy:
+            return LazyResourceTemplate(self, dict(actual_params), encoding=encoding)
+        return self._expanded(actual_params, encoding, self._children.partial_expand(actual_params, encoding=encoding))
+
+    def _expanded(self, actual_params, encoding, resource_templates=None, parent=None):
+        # The expanded template takes its compiled templates with it, so that expanding it further needn't parse them
+        uri = self.bound_template('uri_template',  actual_params, encoding)
+        path = self.bound_template('path_template', actual_params, encoding)
+        expanded = (ResourceTemplate if isinstance(self, (LazyResourceTemplate, SnapshotResourceTemplate)) else type(self))(
+                    parent             = parent,
                     name               = self.name,
                     rel                = self.rel,
-                    uri_template       = self.partial_expand_uri_template(self.uri_template,  actual_params),
-                    path_template      = self.partial_expand_uri_template(self.path_template, actual_params),
+                    uri_template       = uri.template if uri else self.uri_template,
+                    path_template      = path.template if path else self.path_template,
                     params             = [p for p in self.params if p not in actual_params],
                     optional_params    = [p for p in self.optional_params if p not in actual_params],
                     options            = self.options,
-                    resource_templates = self.resource_templates.partial_expand(actual_params))
+                    resource_templates = resource_templates)
+        expanded._compiled_uri_template = uri
+        expanded._compiled_path_template = path
+        return expanded
+
+    def memoize_partial_expansions(self, maxsize=128, ttl=None):
+        """
+        Memoize the results of partial_expand(), keeping up to maxsize of them (None for unbounded) for up to ttl
+        seconds (None for no limit), keyed by their params.  Memoized results are shared by all callers, and are
+        discarded when this template or the tree containing it is modified.
+        """
+        self._partial_expansions = PartialExpansionCache(maxsize, ttl)
+        return self
+
+    def unmemoize_partial_expansions(self):
+        self._partial_expansions = None
+        return self
+
+    def partial_expansion_info(self):
+        """
+        Statistics for memoized partial expansions, or None if they aren't being memoized
+        """
+        if self._partial_expansions is not None:
+            return self._partial_expansions.info()
 
     def partial_expand_uri_template(self, ut, actual_params):
         """
         Partially expand a URI template
         """
         if ut: return uri_template.sub(ut, actual_params, partial=True)
+
+    def partial_expand_template(self, attr, actual_params, encoding=urllib.quote):
+        """
+        Partially expand the named template attribute ('uri_template' or 'path_template') using its compiled form
+        """
+        compiled = self.bound_template(attr, actual_params, encoding)
+        if compiled: return compiled.template
+
+    def bound_template(self, attr, actual_params, encoding=urllib.quote):
+        """
+        The compiled form of the named template attribute with the given params bound (see
+        uri_template.Template.bind()), or None if it isn't set
+        """
+        compiled = self.compiled_template(attr)
+        if compiled: return compiled.bind(actual_params, encoding)
   
     def find_by_rel(self, rel):
         """
-        Find member ResourceTemplate objects with the given rel
+        Find member ResourceTemplate objects with the given rel, from the tree's index if it has one
+        """
+        children = self._children
+        index = children._index
+        if index is not None and index.complete:
+            return list(index.by_parent_rel.get((self, rel), ()))
+        return [t for t in children if t.rel == rel]
+
+
+# The number of bases for which the URIs of a static template (see ResourceTemplate.is_static) are kept
+MAX_STATIC_BASES = 16
+
+def _static_links(rt):
+    """
+    For a template with no params and no expressions in its uri_template or path_template (of which it has at least
+    one), returns (uri_template, path_template, None), the None to be replaced by a dict of URIs keyed by base as
+    they are requested; otherwise None
+    """
+    uri_template, path_template = rt.uri_template, rt.path_template
+    if rt.params or not (uri_template or path_template):
+        return None
+    if (uri_template and '{' in uri_template) or (path_template and '{' in path_template):
+        return None
+    return uri_template, path_template, None
+
+
+class _Expanded(object):
+    """
+    A LazyResourceTemplate or SnapshotResourceTemplate attribute, computed from the template's source on first access
+    and then memoized.  As with ResourceTemplate's setters, assigned names, rels and lists are interned (see
+    Vocabulary), and assigning to params or optional_params discards the memoized sets computed from them.
+    """
+    DEPENDENTS = {'params': ('_param_set',), 'optional_params': ('_optional_param_set',)}
+    INTERNED = {'name': 'string', 'rel': 'string',
+                'params': 'strings', 'optional_params': 'strings', 'options': 'strings'}
+
+    def __init__(self, compute):
+        self.compute = compute
+        self.attr = '_' + compute.__name__
+        self.dependents = tuple('_' + dependent for dependent in self.DEPENDENTS.get(compute.__name__, ()))
+        self.interned = self.INTERNED.get(compute.__name__)
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.attr]
+        except KeyError:
+            value = obj.__dict__[self.attr] = self.compute(obj)
+            return value
+
+    def __set__(self, obj, value):
+        if self.interned is not None:
+            value = getattr(vocabulary, self.interned)(value)
+        obj.__dict__[self.attr] = value
+        if self.dependents:
+            for dependent in self.dependents:
+                obj.__dict__.pop(dependent, None)
+            obj._inherited = None
+        obj._touch()
+
+
+class LazyResourceTemplate(ResourceTemplate):
+    """
+    A view of a source ResourceTemplate partially expanded with some bound params, as returned by
+    ResourceTemplate.partial_expand(actual_params, lazy=True).  The bound params are recorded once for the whole tree,
+    and each attribute - and each level of children - is expanded only when first accessed.  Templates, param lists
+    and options unaffected by the bound params are shared with the source rather than copied, as are their compiled
+    templates.
+    """
+    def __init__(self, source, bound, parent=None, encoding=urllib.quote):
+        self.source = source
+        self.bound = bound
+        self.encoding = encoding
+        self.parent = parent
+        self._collection = None
+        self._partial_expansions = None
+        self.name = source.name
+        self.rel = source.rel
+        self.options = source.options
+        self._compiled_uri_template = self._compiled_path_template = None
+        self._inherited = None
+
+    def _expand_template(self, attr):
+        compiled = self._bound_template(attr)
+        return compiled.template if compiled else getattr(self.source, attr)
+
+    def _bound_template(self, attr):
+        # The source's compiled template with the bound params bound, kept as this template's compiled template
+        slot = COMPILED_SLOTS[attr]
+        compiled = getattr(self, slot)
+        if compiled is None:
+            compiled = self.source.bound_template(attr, self.bound, self.encoding)
+            setattr(self, slot, compiled)
+        return compiled
+
+    def _expand_params(self, attr):
+        params = getattr(self.source, attr)
+        bound = self.bound
+        for p in params:
+            if p in bound:
+                return vocabulary.strings(p for p in params if p not in bound)
+        return params
+
+    @_Expanded
+    def uri_template(self):
+        return self._expand_template('uri_template')
+
+    @_Expanded
+    def path_template(self):
+        return self._expand_template('path_template')
+
+    @_Expanded
+    def params(self):
+        return self._expand_params('params')
+
+    @_Expanded
+    def optional_params(self):
+        return self._expand_params('optional_params')
+
+    @_Expanded
+    def _param_set(self):
+        return vocabulary.string_set(self.params)
+
+    @_Expanded
+    def _optional_param_set(self):
+        return vocabulary.string_set(self.optional_params)
+
+    _static = _Expanded(_static_links)
+
+    @_Expanded
+    def _children(self):
+        children = self.source._children
+        if not children:
+            return EMPTY
+        return ResourceTemplates([LazyResourceTemplate(rt, self.bound, self, self.encoding) for rt in children], self)
+
+    def compiled_template(self, attr):
+        """
+        As ResourceTemplate.compiled_template(), sharing the source's compiled template when unaffected by the bound
+        params, and otherwise binding them without rendering the template's text
+        """
+        if '_' + attr not in self.__dict__:
+            return self._bound_template(attr)
+        return super(LazyResourceTemplate, self).compiled_template(attr)
+
+
+class ResourceTemplateIndex(object):
+    """
+    Lookup tables for a tree of resource templates, built once from its root ResourceTemplates collection and kept
+    in sync as templates are added to the tree:
+
+    by_name::        name -> ResourceTemplate (copied by ResourceTemplates.all_by_name(), see also find_by_name())
+    by_rel::         rel -> list of ResourceTemplate objects anywhere in the tree
+    by_parent_rel::  (parent ResourceTemplate, rel) -> list of member ResourceTemplate objects
+
+    A frozen index is no longer kept up to date, sparing the upkeep for trees that won't be modified.  Either way,
+    its version is incremented whenever the tree is modified, and its epoch whenever the tree is reindexed.
+    """
+    def __init__(self, root, frozen=False):
+        self.root = root
+        self.frozen = frozen
+        self.version = 0
+        self.epoch = 0
+        self.rebuild()
+
+    def rebuild(self):
+        self.version += 1
+        self.by_name = {}
+        self.by_rel = {}
+        self.by_parent_rel = {}
+        self.add_all(self.root, self.root.parent)
+        self.complete = True
+
+    def add_all(self, collection, parent):
+        collection._index = self
+        for rt in collection:
+            self.add(rt, parent)
+
+    def add(self, rt, parent, subtree=True):
+        if rt.name:
+            self.by_name[rt.name] = rt
+        self.by_rel.setdefault(rt.rel, []).append(rt)
+        self.by_parent_rel.setdefault((parent, rt.rel), []).append(rt)
+        if subtree and rt._children:
+            self.add_all(rt._children, rt)
+
+    def remove(self, rt, parent, subtree=True):
+        """
+        Remove the given template, and unless told otherwise its subtree, from the lookup tables
+        """
+        if rt.name and self.by_name.get(rt.name) is rt:
+            del self.by_name[rt.name]
+        for table, key in ((self.by_rel, rt.rel), (self.by_parent_rel, (parent, rt.rel))):
+            templates = table.get(key, [])
+            for i, t in enumerate(templates):
+                if t is rt:
+                    del templates[i]
+                    break
+            if not templates:
+                table.pop(key, None)
+        if subtree:
+            for child in rt._children:
+                self.remove(child, rt)
+
+    def attach(self, rt):
+        """
+        Maintain the index from the given template's subtree without adding it to the lookup tables (when added to
+        a frozen tree)
+        """
+        children = rt._children
+        if children is not EMPTY:
+            children._index = self
+            for child in children:
+                self.attach(child)
+
+    def detach(self, rt):
+        """
+        Stop maintaining the index from the given template's subtree (when removed from the tree)
         """
-        return [t for t in self.resource_templates if t.rel == rel]
+        rt._children._index = None
+        for child in rt._children:
+            self.detach(child)
 
 
 """
 A list of ResourceTemplate objects.
 """
 class ResourceTemplates(list):
+    __slots__ = ('parent', '_index', '_partial_expansions', '_text_widths', '_version', '_hash', '_json')
+
     def __init__(self, collection=[], parent=None):
         """
         Initialize a ResourceTemplates object (a new collection of ResourceTemplate objects) from given collection of
         ResourceTemplates or hashes
         """
         super(ResourceTemplates, self).__init__()
+        self.parent = parent
+        self._index = None
+        self._partial_expansions = None
+        self._text_widths = None
+        self._version = 0
+        self._hash = None
+        self._json = None
         if collection:
+            append = super(ResourceTemplates, self).append
             for rt in collection:
                 if isinstance(rt, ResourceTemplate):
-                    self.append(rt)
+                    # Templates already in a collection stay in it, this one being a view of them
+                    if rt.parent is None:
+                        rt.parent = parent
+                    if rt._collection is None:
+                        rt._collection = self
+                    append(rt)
                 elif isinstance(rt, dict):
-                    self.append(ResourceTemplate(rt, parent))
+                    rt = ResourceTemplate(rt, parent)
+                    rt._collection = self
+                    append(rt)
                 else:
                     raise TypeError(repr(rt) + " is neither a ResourceTemplate nor a dict")
 
+    def __reduce__(self):
+        # Pickled without the index or memoized partial expansions; members are restored after the slots
+        return type(self), (), (self.parent, list(self))
+
+    def __setstate__(self, state):
+        self.parent, members = state
+        self._index = self._partial_expansions = self._text_widths = self._hash = self._json = None
+        self._version = 0
+        for rt in members:
+            rt._collection = self
+        super(ResourceTemplates, self).extend(members)
+
     def to_list(self):
         """
         Convert member ResourceTemplate objects to array of hashes equivalent to their JSON or YAML representations
         """
+        instrumentation = uri_template.instrumentation
+        if instrumentation is not None:
+            return instrumentation.call('to_list', self.parent and self.parent.name, self._counted_to_list, (),
+                                        lambda result: result[1])[0]
+        return self._to_list()
+
+    def _to_list(self):
         return [t.to_dict() for t in self]
+
+    def _counted_to_list(self):
+        # to_list() and the number of templates converted, counted as they are (for instrumentation)
+        count = [0]
+        def convert(collection):
+            count[0] += len(collection)
+            result = []
+            for rt in collection:
+                d = rt._attributes_dict()
+                if rt._children: d['resource_templates'] = convert(rt._children)
+                result.append(d)
+            return result
+        return convert(self), count[0]
+
+    def stream(self, format='json'):
+        """
+        Returns a generator of chunks of the JSON, YAML or XML representation of this collection, walking the tree as
+        it goes rather than building it as a list of dicts first.  It can be returned as is from a WSGI application.
+        """
+        return serialisers[format][0](self)
+
+    def to_json(self, cache=False):
+        """
+        The JSON representation of this collection, as a string.  If cache, the JSON of this collection and of each
+        collection below it is kept, to be reused by later calls with cache until the collection or its subtree is
+        modified, so that after a change only the modified collections and those above them are encoded again, their
+        unaffected members' JSON being concatenated.  Caching indexes the tree if this collection is its root, and
+        otherwise takes place only in an indexed tree (see get_index()).
+        """
+        if cache:
+            self._index_root()
+            return _cached_json_templates(self)
+        return ''.join(_json_templates(self))
+
+    def write(self, out, format='json'):
+        """
+        Write the JSON, YAML or XML representation of this collection incrementally to a file-like object, or with
+        format 'snapshot', a binary snapshot of it for load_snapshot()
+        """
+        for chunk in self.stream(format):
+            out.write(chunk)
         
     def all_by_name(self, d = None):
         """
-        Get a dict of all named ResourceTemplate objects contained in the supplied collection, keyed by name
+        Get a dict of all named ResourceTemplate objects contained in the supplied collection, keyed by name.  Unless
+        this collection is nested within an indexed tree, this is a copy of the dict of the collection's index; use
+        find_by_name() to look up a single name without the copy.
         """
+        instrumentation = uri_template.instrumentation
+        if instrumentation is not None and d is None:
+            return instrumentation.call('all_by_name', self.parent and self.parent.name, self._all_by_name, (d,), len)
+        return self._all_by_name(d)
+
+    def _all_by_name(self, d):
         if d is None:
+            if self._index is None:
+                return dict(self.get_index().by_name)
+            if self._index.root is self:
+                return dict(self._index.by_name)
             d = {}
         
         for rt in self:
             if rt.name:
                 d[rt.name] = rt
-            rt.resource_templates.all_by_name(d)
+            rt._children._all_by_name(d)
         
         return d
 
+    def find_by_name(self, name):
+        """
+        Get the ResourceTemplate in or below this collection with the given name, or None.  Unless this collection is
+        nested within an indexed tree, this is a lookup in the collection's index.
+        """
+        index = self._index
+        if index is None:
+            index = self.get_index()
+        elif index.root is not self:
+            return self._all_by_name({}).get(name)
+        return index.by_name.get(name)
+
+    def all_by_rel(self, rel):
+        """
+        Get a list of all ResourceTemplate objects in or below this collection with the given rel
+        """
+        index = self.get_index()
+        if index.root is self:
+            return list(index.by_rel.get(rel, ()))
+        return [rt for rt in self._walk() if rt.rel == rel]
+
+    def _walk(self):
+        for rt in self:
+            yield rt
+            for descendant in rt._children._walk():
+                yield descendant
+
+    def get_index(self, frozen=False):
+        """
+        Returns the ResourceTemplateIndex of the tree containing this collection, building one for this collection
+        (as the root of its tree) if there isn't one yet
+        """
+        if self._index is None:
+            ResourceTemplateIndex(self, frozen)
+        return self._index
+
+    def freeze(self):
+        """
+        Build this tree's index if necessary and stop maintaining it, for trees that won't be modified further
+        """
+        self.get_index().frozen = True
+        return self
+
+    def thaw(self):
+        """
+        Resume maintenance of a frozen index, rebuilding it to catch up with any changes made meanwhile
+        """
+        index = self.get_index()
+        index.frozen = False
+        index.rebuild()
+        return self
+
+    def reindex(self):
+        """
+        Rebuild the index of the tree containing this collection, e.g. after changing a template's attributes in place
+        (which also discards the tree's memoized partial expansions)
+        """
+        if self._index is not None:
+            self._index.rebuild()
+            self._index.epoch += 1
+
+    def _stamp(self):
+        """
+        Identifies the state of this collection and its subtree, for the validation of what's derived from them: it
+        changes whenever they are modified (see _touch()) or the tree is reindexed.  Returns None, meaning that
+        nothing derived from them should be kept, if the collection isn't indexed: it may be a temporary view of
+        templates belonging to other collections, whose changes don't reach it, and indexing it would take over the
+        index maintenance of their subtrees.
+        """
+        index = self._index
+        if index is None:
+            return None
+        return index, index.epoch, self._version
+
+    def _index_root(self):
+        # Index this collection if it is the root of a tree (rather than a view of other collections' templates), so
+        # that what's derived from it can be cached
+        if self._index is None and self.parent is None and all(rt._collection is self for rt in self):
+            self.get_index()
+
+    def _touch(self):
+        """
+        Bump the versions of this collection and of the collections above it in its tree, invalidating what's derived
+        from them (but not from the rest of the tree)
+        """
+        collection = self
+        while collection is not None:
+            collection._version += 1
+            collection = collection._container()
+
+    def _container(self):
+        parent = self.parent
+        if parent is None:
+            return None
+        return parent._collection
+
+    def _adopt(self, templates):
+        for rt in templates:
+            rt._collection = self
+
+    def _release(self, templates):
+        for rt in templates:
+            if rt._collection is self:
+                rt._collection = None
+
+    def _changed(self, removed=(), added=()):
+        self._touch()
+        index = self._index
+        if index is not None:
+            for rt in removed:
+                index.detach(rt)
+            if index.frozen:
+                index.complete = False
+                index.version += 1
+                for rt in added:
+                    index.attach(rt)
+            else:
+                index.rebuild()
+
+    def append(self, rt):
+        super(ResourceTemplates, self).append(rt)
+        rt._collection = self
+        self._touch()
+        index = self._index
+        if index is not None:
+            index.version += 1
+            if index.frozen:
+                index.complete = False
+                index.attach(rt)
+            else:
+                index.add(rt, self.parent)
+
+    def extend(self, collection):
+        for rt in collection:
+            self.append(rt)
+
+    def __iadd__(self, collection):
+        self.extend(collection)
+        return self
+
+    def insert(self, i, rt):
+        super(ResourceTemplates, self).insert(i, rt)
+        rt._collection = self
+        self._changed(added=[rt])
+
+    def remove(self, rt):
+        super(ResourceTemplates, self).remove(rt)
+        self._release([rt])
+        self._changed([rt])
+
+    def pop(self, *args):
+        rt = super(ResourceTemplates, self).pop(*args)
+        self._release([rt])
+        self._changed([rt])
+        return rt
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            removed, value = self[i], list(value)
+        else:
+            removed = [self[i]]
+        super(ResourceTemplates, self).__setitem__(i, value)
+        added = value if isinstance(i, slice) else [value]
+        self._release(removed)
+        self._adopt(added)
+        self._changed(removed, added)
+
+    def __delitem__(self, i):
+        removed = self[i] if isinstance(i, slice) else [self[i]]
+        super(ResourceTemplates, self).__delitem__(i)
+        self._release(removed)
+        self._changed(removed)
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
     def to_table(self, parent_template=None, table=None, indent=''):
         """
         For to_text()
         """
         if table is None:
             table = []
-        
-        for rt in self:
-            if parent_template:
-                link = rt.rel or ''
-                new_params = [p for p in rt.params if p not in parent_template.params]
-            else:
-                link = rt.name
-                new_params = rt.params
-            table.append([
-                indent + link + ', '.join(['{' + p + '}' for p in new_params]),
-                rt.name or '',
-                ', '.join(rt.options),
-                rt.uri_template or rt.path_template])
-            rt.resource_templates.to_table(rt,  table, indent + '  ')
-
+        table.extend(list(row) for row in _text_rows(self, parent_template, indent))
         return table
 
+    def text_lines(self, depth=None, name_prefix=None):
+        """
+        Returns a generator of the lines of the text report (as returned by str()), limited to depth levels of the tree
+        if given.  With a name_prefix, the report covers only the templates whose names start with it, each with its
+        subtree.  Column widths are found in a pre-pass over the tree, so that rows are formatted one at a time rather
+        than held in memory.  In an indexed tree the widths are kept until the tree is modified (see reindex()), so
+        that rendering the same report again takes a single pass; no index is built for the purpose, as that would
+        take over the index maintenance of any tree this collection is a temporary view of (see ResourceTemplate's
+        __str__()).
+        """
+        templates = self if name_prefix is None else list(_matching(self, name_prefix))
+        if not templates:
+            return
+        stamp = self._stamp()
+        key = (stamp, depth, name_prefix) if stamp is not None else None
+        if key is not None and self._text_widths is not None and self._text_widths[0] == key:
+            width0, width1, width2 = self._text_widths[1]
+        else:
+            width0 = width1 = width2 = 0
+            for link, name, options, template in _text_rows(templates, depth=depth):
+                if len(link) > width0:
+                    width0 = len(link)
+                if len(name) > width1:
+                    width1 = len(name)
+                if len(options) > width2:
+                    width2 = len(options)
+            self._text_widths = (key, (width0, width1, width2))
+        for row in _text_rows(templates, depth=depth):
+            yield '%-*s %-*s %-*s %s\n' % (width0, row[0], width1, row[1], width2, row[2], row[3])
+
+    def write_text(self, out, depth=None, name_prefix=None):
+        """
+        Write the text report incrementally to a file-like object; see text_lines()
+        """
+        for line in self.text_lines(depth, name_prefix):
+            out.write(line)
+
     def __str__(self):
         """
         Text report
         """
-        table = self.to_table()
-        
-        for col in range(3):
-            col_width = max([len(row[col]) for row in table])
-            for row in table:
-                row[col] = row[col].ljust(col_width)
-        
-        return '\n'.join([' '.join(row) for row in table] + [''])
-        
-    def partial_expand(self, actual_params):
+        return ''.join(self.text_lines())
+
+    def partial_expand(self, actual_params, lazy=False, encoding=urllib.quote):
         """
         Partially expand the path_template or uri_template of the given resource templates with the given params,
-        returning new resource templates
+        returning new resource templates.  If lazy, these are LazyResourceTemplate objects sharing a single copy of the
+        params, their attributes and children expanded only when accessed.
         """
-        return type(self)([rt.partial_expand(actual_params) for rt in self])
+        if self._partial_expansions is not None:
+            return self._partial_expansions.lookup(self._stamp(), actual_params, lazy, encoding, self._partial_expand)
+        return self._partial_expand(actual_params, lazy, encoding)
 
+    def _partial_expand(self, actual_params, lazy, encoding):
+        if lazy:
+            bound = dict(actual_params)
+            return type(self)([LazyResourceTemplate(rt, bound, encoding=encoding) for rt in self])
+        expanded = type(self)([rt.partial_expand(actual_params, encoding=encoding) for rt in self])
+        if self._index is not None and self._index.root is self:
+            expanded.get_index(self._index.frozen)
+        return expanded
 
-if __name__ == "__main__":
-    import unittest
+    def partial_expand_steps(self, actual_params, step=COOPERATIVE_STEP, encoding=urllib.quote, executor=None,
+                             threshold=OFFLOAD_THRESHOLD):
+        """
+        Cooperative partial_expand() for event-driven servers; see cooperatively()
+        """
+        return cooperatively(self._partial_expand_steps(actual_params, step, encoding),
+                             executor, threshold, self, self.partial_expand, actual_params, False, encoding)
 
-    data = \
-        [
-            {
-                'name':               'users',
-                'uri_template':       'http://example.com/users{-prefix|.|format}',
-                'optional_params':    ['format'],
-                'options':            ['GET', 'POST'],
-                'resource_templates': [
-                    {
-                        'name':               'new_user',
+    def _partial_expand_steps(self, actual_params, step, encoding):
+        expanded = type(self)()
+        queue = [(self, expanded)]
+        count = 0
+        for source, target in queue:
+            for rt in source:
+                new = rt._expanded(actual_params, encoding, parent=target.parent)
+                target.append(new)
+                if rt._children:
+                    new._children = ResourceTemplates((), new)
+                    queue.append((rt._children, new._children))
+                count += 1
+                if count % step == 0:
+                    yield None
+        if self._index is not None and self._index.root is self:
+            expanded.get_index(self._index.frozen)
+        yield expanded
+
+    def to_list_steps(self, step=COOPERATIVE_STEP, executor=None, threshold=OFFLOAD_THRESHOLD):
+        """
+        Cooperative to_list() for event-driven servers; see cooperatively()
+        """
+        return cooperatively(self._to_list_steps(step), executor, threshold, self, self.to_list)
+
+    def _to_list_steps(self, step):
+        result = []
+        queue = [(self, result)]
+        count = 0
+        for source, target in queue:
+            for rt in source:
+                d = rt._attributes_dict()
+                target.append(d)
+                if rt._children:
+                    d['resource_templates'] = []
+                    queue.append((rt._children, d['resource_templates']))
+                count += 1
+                if count % step == 0:
+                    yield None
+        yield result
+
+    def memoize_partial_expansions(self, maxsize=128, ttl=None):
+        """
+        Memoize the results of partial_expand(), keeping up to maxsize of them (None for unbounded) for up to ttl
+        seconds (None for no limit), keyed by their params.  Memoized results are shared by all callers, and are
+        discarded when the tree containing this collection is modified (see reindex()).  As with to_json(cache=True),
+        this indexes the tree if this collection is its root, and results are memoized only in an indexed tree.
+        """
+        self._index_root()
+        self._partial_expansions = PartialExpansionCache(maxsize, ttl)
+        return self
+
+    def unmemoize_partial_expansions(self):
+        self._partial_expansions = None
+        return self
+
+    def partial_expansion_info(self):
+        """
+        Statistics for memoized partial expansions, or None if they aren't being memoized
+        """
+        if self._partial_expansions is not None:
+            return self._partial_expansions.info()
+
+    def uris_for(self, param_rows, base=None, encoding=urllib.quote):
+        """
+        Returns a generator of dicts, one for each of the given params dicts, of the URIs of this collection's named
+        templates keyed by name.  Templates are prepared once for the whole batch; a template whose mandatory params
+        aren't all in a params dict is left out of that dict's URIs, as are templates lacking a uri_template when no
+        base is given.
+        """
+        templates = [(rt.name, rt.params, rt.expansion_template(base))
+                        for rt in self if rt.name and rt.uri_template_for_base(base)]
+        return self._expand_rows(templates, param_rows, encoding)
+
+    def uris_for_columns(self, columns, base=None, encoding=urllib.quote):
+        """
+        Like uris_for(), but taking a dict of equal-length param sequences, keyed by param name
+        """
+        return self.uris_for(param_rows(columns), base, encoding)
+
+    def _expand_rows(self, templates, param_rows, encoding):
+        for actual_params in param_rows:
+            uris = {}
+            for name, required, template in templates:
+                for p in required:
+                    if p not in actual_params:
+                        break
+                else:
+                    uris[name] = template.expand(actual_params, encoding)
+            yield uris
+
+    def partial_expand_all(self, param_sets, format='json', processes=None, chunksize=None, encoding=urllib.quote):
+        """
+        Partially expand and serialise this collection for each of many params dicts in parallel; see
+        partial_expand_all()
+        """
+        return partial_expand_all(self, param_sets, format, processes, chunksize, encoding)
+
+    def structural_hash(self):
+        """
+        A hash of the templates in and below this collection, equal for collections with equal to_list()
+        representations.  In an indexed tree, it is cached until this collection or its subtree is modified (or the
+        tree is reindexed).
+        """
+        if not self:
+            return hash(())
+        stamp = self._stamp()
+        if stamp is None:
+            return hash(tuple(rt.structural_hash() for rt in self))
+        if self._hash is None or self._hash[0] != stamp:
+            self._hash = (stamp, hash(tuple(rt.structural_hash() for rt in self)))
+        return self._hash[1]
+
+    def diff(self, other):
+        """
+        Compare this tree with another, typically one rebuilt after routes have changed, returning a TreeDiff of:
+
+        added::    (parent, position, template) for each template of the other tree that is missing from this one,
+                   where parent is the template of this tree to add it under (None at the top) with its subtree
+        removed::  each template of this tree that is missing from the other, with its subtree
+        changed::  (template, other template) for each template with attributes (children aside) that differ
+
+        Templates are matched by name, or if unnamed, by rel and position among their unnamed siblings of the same rel.
+        Subtrees with equal structural hashes are skipped.
+        """
+        diff = TreeDiff([], [], [])
+        _diff(self, other, None, diff)
+        return diff
+
+    def patch(self, diff):
+        """
+        Apply a TreeDiff from diff() to this tree in place, bringing it into line with the other tree (except for the
+        order of the templates common to both).  Added templates are copies.  The index is updated incrementally
+        (unless frozen), and memoized partial expansions, text report widths and structural hashes are discarded
+        only for the collections that were modified and those above them.
+        """
+        index = self.get_index()
+        def upkeep(func, *args):
+            index.version += 1
+            if index.frozen:
+                index.complete = False
+            else:
+                func(*args)
+
+        for rt in diff.removed:
+            collection = self if rt in self else rt.parent._children
+            super(ResourceTemplates, collection).remove(rt)
+            collection._release([rt])
+            upkeep(index.remove, rt, rt.parent)
+            index.detach(rt)
+            collection._touch()
+        for rt, other in diff.changed:
+            upkeep(index.remove, rt, rt.parent, False)
+            for attr in ATTRIBUTES:
+                setattr(rt, attr, getattr(other, attr))
+            rt._static = _static_links(rt)
+            upkeep(index.add, rt, rt.parent, False)
+        for parent, position, other in diff.added:
+            collection = self if parent is None else parent.resource_templates
+            rt = ResourceTemplate(other.to_dict(), collection.parent)
+            super(ResourceTemplates, collection).insert(position, rt)
+            rt._collection = collection
+            upkeep(index.add, rt, collection.parent)
+            if index.frozen:
+                index.attach(rt) # tables aside, its subtree's collections still need the index
+            collection._touch()
+        return self
+
+    def update(self, other):
+        """
+        Bring this tree into line with another in place, returning the TreeDiff applied; see diff() and patch()
+        """
+        diff = self.diff(other)
+        self.patch(diff)
+        return diff
+
+    def static_templates(self):
+        """
+        The templates in or below this collection whose URIs and paths are precomputed (see ResourceTemplate.is_static)
+        """
+        return [rt for rt in self._walk() if rt.is_static]
+
+    def memory_report(self):
+        """
+        Returns a MemoryReport of the heap held by the templates in or below this collection: its total in bytes
+        (counting shared objects once, and excluding anything above the collection), the bytes of each attribute in
+        ATTRIBUTES across the tree, and the number of attribute values referred to against the number of distinct
+        objects among them (see Vocabulary).  Lazy and snapshot templates are expanded or decoded in the process.
+        """
+        seen = set()
+        if self.parent is not None:
+            seen.add(id(self.parent))
+        nodes = values = 0
+        distinct = set()
+        attributes = dict.fromkeys(ATTRIBUTES, 0)
+        for rt in self._walk():
+            nodes += 1
+            for attr in ATTRIBUTES:
+                value = getattr(rt, attr)
+                if value is not None:
+                    values += 1
+                    distinct.add(id(value))
+                attributes[attr] += deep_sizeof(value, seen)
+        return MemoryReport(nodes, deep_sizeof(self, seen) + sum(attributes.itervalues()), attributes, values,
+                            len(distinct))
+
+    def matcher(self):
+        """
+        Returns a ResourceTemplateMatcher for the templates in or below this collection
+        """
+        return ResourceTemplateMatcher(self)
+
+
+TreeDiff = collections.namedtuple('TreeDiff', 'added removed changed')
+
+MemoryReport = collections.namedtuple('MemoryReport', 'nodes bytes attribute_bytes values distinct_values')
+
+DERIVED_SLOTS = frozenset(['_index', '_partial_expansions', '_json', '_text_widths', '_hash'])
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns the size in bytes of obj and of everything reachable from it (other than classes, functions and
+    modules), counting shared objects once, and skipping those whose ids are already in seen.  Slots named in
+    DERIVED_SLOTS are skipped too: they hold caches derived from the tree, and the index among them reaches the whole
+    of it through its root.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (type, type(deep_sizeof), type(urllib))):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if slot not in DERIVED_SLOTS and hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+def _diff(collection, other, parent, diff):
+    if collection.structural_hash() == other.structural_hash():
+        return
+    members = dict(_diff_keys(collection))
+    other_keys = set()
+    for position, (key, other_rt) in enumerate(_diff_keys(other)):
+        other_keys.add(key)
+        rt = members.get(key)
+        if rt is None:
+            diff.added.append((parent, position, other_rt))
+        else:
+            if any(getattr(rt, attr) != getattr(other_rt, attr) for attr in ATTRIBUTES):
+                diff.changed.append((rt, other_rt))
+            _diff(rt._children, other_rt._children, rt, diff)
+    diff.removed.extend(rt for key, rt in _diff_keys(collection) if key not in other_keys)
+
+def _diff_keys(collection):
+    unnamed = collections.defaultdict(int)
+    for rt in collection:
+        if rt.name:
+            yield rt.name, rt
+        else:
+            yield (rt.rel, unnamed[rt.rel]), rt
+            unnamed[rt.rel] += 1
+
+PartialExpansionInfo = collections.namedtuple('PartialExpansionInfo',
+                                              'hits misses evictions maxsize currsize invalidations')
+
+class PartialExpansionCache(object):
+    """
+    Memoized partial expansions of a template or collection keyed by their params, discarded whenever the stamp of
+    the collection they came from changes (see ResourceTemplates._stamp()) or the template they came from is
+    modified.  Nothing is memoized while the stamp is None.
+    """
+    def __init__(self, maxsize=128, ttl=None):
+        self.expansions = uri_template.LRUCache(maxsize, ttl)
+        self.stamp = None
+        self.invalidations = 0
+
+    def lookup(self, stamp, actual_params, lazy, encoding, expand):
+        if stamp is None:
+            return expand(actual_params, lazy, encoding)
+        if stamp != self.stamp:
+            if self.stamp is not None:
+                self.invalidations += 1
+                self.expansions.clear(keep_stats=True)
+            self.stamp = stamp
+        try:
+            key = (frozenset((k, tuple(v) if isinstance(v, list) else v) for k, v in actual_params.iteritems()),
+                   lazy, encoding)
+            hash(key)
+        except TypeError:
+            return expand(actual_params, lazy, encoding)
+        expanded = self.expansions.get(key)
+        if expanded is None:
+            expanded = self.expansions[key] = expand(actual_params, lazy, encoding)
+        return expanded
+
+    def invalidate(self):
+        if self.stamp is not None:
+            self.invalidations += 1
+            self.expansions.clear(keep_stats=True)
+            self.stamp = None
+
+    def info(self):
+        return PartialExpansionInfo(*(self.expansions.info() + (self.invalidations,)))
+
+
+VocabularyInfo = collections.namedtuple('VocabularyInfo', 'strings tuples sets')
+
+class Vocabulary(object):
+    """
+    Interned names, rels, params and options.  Equal strings, equal tuples of strings and the frozensets of those
+    tuples are each mapped to a single shared object, so that a large tree - and its partial expansions - holds one
+    copy of each param list, option list, name and rel however often they recur, and so that they can be compared
+    by identity.  Strings are only ever shared with strings of the same type (str or unicode).  Templates intern
+    their values through the module's vocabulary as they are constructed; nothing is interned otherwise, and
+    entries are kept until clear() is called.
+    """
+    def __init__(self):
+        self.clear()
+
+    def string(self, s):
+        """
+        The shared string equal to s (None and other non-strings are returned as they are)
+        """
+        if s.__class__ is str:
+            return self.str_strings.setdefault(s, s)
+        if s.__class__ is unicode:
+            return self.unicode_strings.setdefault(s, s)
+        return s
+
+    def strings(self, values):
+        """
+        The shared tuple of the shared strings in values
+        """
+        values = tuple(values)
+        shared = self.tuples.get(values)
+        if shared is not None and map(type, shared) == map(type, values):
+            return shared
+        # Equal but of other string types (str against unicode): those are keyed by the identity of their strings
+        values = tuple([self.string(value) for value in values])
+        if shared is None:
+            return self.tuples.setdefault(values, values)
+        return self.typed_tuples.setdefault(tuple([id(value) for value in values]), values)
+
+    def string_set(self, values):
+        """
+        The shared frozenset of a tuple returned by strings()
+        """
+        # Kept with the tuple itself, whose id would otherwise be free for reuse were it collected
+        try:
+            return self.sets[id(values)][1]
+        except KeyError:
+            return self.sets.setdefault(id(values), (values, frozenset(values)))[1]
+
+    def info(self):
+        return VocabularyInfo(len(self.str_strings) + len(self.unicode_strings),
+                              len(self.tuples) + len(self.typed_tuples), len(self.sets))
+
+    def clear(self):
+        """
+        Forget the interned values (templates already constructed keep theirs)
+        """
+        self.str_strings = {}
+        self.unicode_strings = {}
+        self.tuples = {}
+        self.typed_tuples = {}
+        self.sets = {}
+
+vocabulary = Vocabulary()
+
+
+class _NoResourceTemplates(ResourceTemplates):
+    """
+    The type of EMPTY, the immutable ResourceTemplates shared by templates without any
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args):
+        raise TypeError('the shared empty ResourceTemplates is immutable')
+
+    append = extend = insert = remove = pop = __iadd__ = _immutable
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _immutable
+
+    def partial_expand(self, actual_params, lazy=False, encoding=urllib.quote):
+        return self
+
+    def __reduce__(self):
+        return 'EMPTY'
+
+EMPTY = _NoResourceTemplates()
+
+COMPILED_SLOTS = {'uri_template': '_compiled_uri_template', 'path_template': '_compiled_path_template'}
+
+PICKLED_ATTRIBUTES = ATTRIBUTES + ('_children', 'parent')
+
+
+# Streaming serialisers, yielding a chunk or so per template.  Attributes appear in the order of ATTRIBUTES, and as
+# with to_dict(), empty ones are omitted.
+
+def _attributes(rt):
+    for attr in ATTRIBUTES:
+        val = getattr(rt, attr)
+        if val:
+            yield attr, val
+
+def _json_templates(collection):
+    yield '['
+    for i, rt in enumerate(collection):
+        if i:
+            yield ', '
+        for chunk in _json_template(rt):
+            yield chunk
+    yield ']'
+
+def _json_members(rt):
+    return ['"%s": %s' % (attr, json.dumps(val)) for attr, val in _attributes(rt)]
+
+def _json_template(rt):
+    members = _json_members(rt)
+    if rt._children:
+        members.append('"resource_templates": ')
+        yield '{' + ', '.join(members)
+        for chunk in _json_templates(rt._children):
+            yield chunk
+        yield '}'
+    else:
+        yield '{' + ', '.join(members) + '}'
+
+def _cached_json_templates(collection):
+    if not collection:
+        return '[]'
+    stamp = collection._stamp()
+    if stamp is None:
+        return '[' + ', '.join(_cached_json_template(rt) for rt in collection) + ']'
+    cached = collection._json
+    if cached is None or cached[0] != stamp:
+        cached = collection._json = (stamp, '[' + ', '.join(_cached_json_template(rt) for rt in collection) + ']')
+    return cached[1]
+
+def _cached_json_template(rt):
+    members = _json_members(rt)
+    if rt._children:
+        members.append('"resource_templates": ' + _cached_json_templates(rt._children))
+    return '{' + ', '.join(members) + '}'
+
+def _yaml_templates(collection, indent=''):
+    if not collection:
+        yield indent + '[]\n'
+    for rt in collection:
+        for chunk in _yaml_template(rt, indent, '- '):
+            yield chunk
+
+def _yaml_template(rt, indent='', lead=''):
+    lines = []
+    for attr, val in _attributes(rt):
+        lines.append('%s%s%s: %s\n' % (indent, lead, attr, json.dumps(val)))
+        lead = ' ' * len(lead)
+    if rt._children:
+        lines.append('%s%sresource_templates:\n' % (indent, lead))
+        yield ''.join(lines)
+        for chunk in _yaml_templates(rt._children, indent + len(lead) * ' ' + '  '):
+            yield chunk
+    elif lines:
+        yield ''.join(lines)
+    else:
+        yield '%s%s{}\n' % (indent, lead)
+
+def _xml_templates(collection, indent=''):
+    yield indent + '<ResourceTemplates>\n'
+    for rt in collection:
+        for chunk in _xml_template(rt, indent + '  '):
+            yield chunk
+    yield indent + '</ResourceTemplates>\n'
+
+def _xml_template(rt, indent=''):
+    lines = [indent + '<ResourceTemplate>\n']
+    for attr, val in _attributes(rt):
+        if attr in ('params', 'optional_params'):
+            element = 'Params' if attr == 'params' else 'OptionalParams'
+            lines.append('%s  <%s>\n' % (indent, element))
+            lines.extend('%s    <param>%s</param>\n' % (indent, escape(p)) for p in val)
+            lines.append('%s  </%s>\n' % (indent, element))
+        elif attr == 'options':
+            lines.append('%s  <options>%s</options>\n' % (indent, escape(', '.join(val))))
+        else:
+            lines.append('%s  <%s>%s</%s>\n' % (indent, attr, escape(val), attr))
+    yield ''.join(lines)
+    if rt._children:
+        for chunk in _xml_templates(rt._children, indent + '  '):
+            yield chunk
+    yield indent + '</ResourceTemplate>\n'
+
+# Binary snapshots: a header, a table of strings (names, rels, templates and params, each stored once), a table of
+# lists of strings (params, optional_params and options), and a flat array of fixed-size node records in breadth-first
+# order, so that each node's children are contiguous.  Integers are little-endian; None is stored as SNAPSHOT_NONE.
+#
+# header::  magic, string count, list count, list item count, node count, root count
+# then::    string offsets (string count + 1, relative to the string data), list offsets (list count + 1, relative to
+#           the list items), list items (string ids), node records, string data (UTF-8)
+
+SNAPSHOT_MAGIC = 'DRSNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8s5I')
+SNAPSHOT_NODE = struct.Struct('<i9I')  # parent, first child, child count, then the ids of ATTRIBUTES
+SNAPSHOT_OFFSETS = struct.Struct('<2I')
+SNAPSHOT_NONE = 0xffffffff
+
+def _snapshot_templates(collection):
+    strings = {}
+    lists = {(): 0}
+    def string_id(s):
+        if s is None:
+            return SNAPSHOT_NONE
+        return strings.setdefault(s.encode('utf-8') if isinstance(s, unicode) else s, len(strings))
+    def list_id(values):
+        return lists.setdefault(tuple(string_id(v) for v in values), len(lists))
+
+    order = [(rt, -1) for rt in collection]
+    records = []
+    for i, (rt, parent) in enumerate(order):
+        children = rt._children
+        records.append(SNAPSHOT_NODE.pack(parent, len(order), len(children),
+                                          string_id(rt.name), string_id(rt.rel),
+                                          string_id(rt.uri_template), string_id(rt.path_template),
+                                          list_id(rt.params), list_id(rt.optional_params), list_id(rt.options)))
+        order.extend((child, i) for child in children)
+
+    string_values = sorted(strings, key=strings.get)
+    list_values = sorted(lists, key=lists.get)
+    items = sum(map(len, list_values))
+    yield SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(string_values), len(list_values), items, len(records),
+                               len(collection))
+    yield _offsets(string_values)
+    yield _offsets(list_values)
+    yield struct.pack('<%dI' % items, *itertools.chain.from_iterable(list_values))
+    yield ''.join(records)
+    yield ''.join(string_values)
+
+def _snapshot_template(rt):
+    return _snapshot_templates([rt])
+
+def _offsets(values):
+    offsets = [0]
+    for v in values:
+        offsets.append(offsets[-1] + len(v))
+    return struct.pack('<%dI' % len(offsets), *offsets)
+
+serialisers = {
+    'json':     (_json_templates,     _json_template),
+    'yaml':     (_yaml_templates,     _yaml_template),
+    'xml':      (_xml_templates,      _xml_template),
+    'snapshot': (_snapshot_templates, _snapshot_template)
+}
+
+
+class Snapshot(object):
+    """
+    A binary snapshot of a tree of resource templates, as written by write(out, 'snapshot'), read in place from a
+    string, mmap or other buffer.  Each string and list is decoded on first use and then shared by all the templates
+    that refer to it.
+    """
+    def __init__(self, buf):
+        magic, strings, lists, items, nodes, self.roots = SNAPSHOT_HEADER.unpack_from(buf)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('not a resource templates snapshot')
+        self.buf = buf
+        self.string_offsets = SNAPSHOT_HEADER.size
+        self.list_offsets = self.string_offsets + 4 * (strings + 1)
+        self.list_items = self.list_offsets + 4 * (lists + 1)
+        self.nodes = self.list_items + 4 * items
+        self.string_data = self.nodes + SNAPSHOT_NODE.size * nodes
+        self.strings = {SNAPSHOT_NONE: None}
+        self.lists = {0: ()}
+
+    def string(self, i):
+        try:
+            return self.strings[i]
+        except KeyError:
+            start, end = SNAPSHOT_OFFSETS.unpack_from(self.buf, self.string_offsets + 4 * i)
+            s = self.buf[self.string_data + start:self.string_data + end]
+            try:
+                s.decode('ascii')
+            except UnicodeDecodeError:
+                s = s.decode('utf-8')
+            self.strings[i] = s
+            return s
+
+    def list(self, i):
+        try:
+            return self.lists[i]
+        except KeyError:
+            start, end = SNAPSHOT_OFFSETS.unpack_from(self.buf, self.list_offsets + 4 * i)
+            ids = struct.unpack_from('<%dI' % (end - start), self.buf, self.list_items + 4 * start)
+            values = self.lists[i] = vocabulary.strings(self.string(j) for j in ids)
+            return values
+
+    def node(self, i):
+        return SNAPSHOT_NODE.unpack_from(self.buf, self.nodes + SNAPSHOT_NODE.size * i)
+
+    def resource_templates(self, first=0, count=None, parent=None):
+        """
+        A ResourceTemplates collection of the count templates from the given node, by default the roots of the tree
+        """
+        if count is None:
+            count = self.roots
+        return ResourceTemplates([SnapshotResourceTemplate(self, i, parent) for i in xrange(first, first + count)],
+                                 parent)
+
+
+def _snapshot_attribute(attr, field, decode):
+    def compute(self):
+        return decode(self.snapshot, self.record[field])
+    compute.__name__ = attr
+    return _Expanded(compute)
+
+class SnapshotResourceTemplate(ResourceTemplate):
+    """
+    A ResourceTemplate backed by a node of a Snapshot, its attributes decoded and its children built on first access
+    """
+    def __init__(self, snapshot, i, parent=None):
+        self.snapshot = snapshot
+        self.record = snapshot.node(i)
+        self.parent = parent
+        self._compiled_uri_template = self._compiled_path_template = None
+        self._partial_expansions = None
+        self._inherited = None
+        self._collection = None
+
+    name            = _snapshot_attribute('name',            3, Snapshot.string)
+    rel             = _snapshot_attribute('rel',             4, Snapshot.string)
+    uri_template    = _snapshot_attribute('uri_template',    5, Snapshot.string)
+    path_template   = _snapshot_attribute('path_template',   6, Snapshot.string)
+    params          = _snapshot_attribute('params',          7, Snapshot.list)
+    optional_params = _snapshot_attribute('optional_params', 8, Snapshot.list)
+    options         = _snapshot_attribute('options',         9, Snapshot.list)
+    _static         = _Expanded(_static_links)
+
+    @_Expanded
+    def _param_set(self):
+        return vocabulary.string_set(self.params)
+
+    @_Expanded
+    def _optional_param_set(self):
+        return vocabulary.string_set(self.optional_params)
+
+    @_Expanded
+    def _children(self):
+        parent, first, count = self.record[:3]
+        if not count:
+            return EMPTY
+        return self.snapshot.resource_templates(first, count, self)
+
+
+def load_snapshot(filename):
+    """
+    Returns the ResourceTemplates collection of a snapshot file, mapped read-only into memory so that its pages are
+    shared by all the processes that load it (or that fork after loading it) rather than copied.  Templates are built
+    as they're reached, and their attributes as they're accessed.
+    """
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(buf).resource_templates()
+
+
+# Rows of the text report: a (link, name, options, template) tuple per template, children indented below their parent
+
+def _text_rows(templates, parent_template=None, indent='', depth=None):
+    # Depth first, with a stack of member iterators rather than nested generators
+    stack = [(iter(templates), parent_template, indent, depth)]
+    while stack:
+        members, parent_template, indent, depth = stack[-1]
+        for rt in members:
+            if parent_template:
+                link = rt.rel or ''
+                excluded = rt.inherited_param_set if parent_template is rt.parent else parent_template.param_set
+                new_params = [p for p in rt.params if p not in excluded]
+            else:
+                link = rt.name
+                new_params = rt.params
+            yield (indent + link + ', '.join(['{' + p + '}' for p in new_params]),
+                   rt.name or '',
+                   ', '.join(rt.options),
+                   rt.uri_template or rt.path_template or '')
+            if depth != 1 and rt._children:
+                stack.append((iter(rt._children), rt, indent + '  ', depth and depth - 1))
+                break
+        else:
+            stack.pop()
+
+def _matching(templates, name_prefix):
+    for rt in templates:
+        if rt.name and rt.name.startswith(name_prefix):
+            yield rt
+        else:
+            for match in _matching(rt._children, name_prefix):
+                yield match
+
+
+# Cooperative variants of the heavy ResourceTemplates operations, for event-driven servers.  The stream() methods are
+# cooperative already, yielding a chunk or so per template.
+
+def cooperatively(steps, executor, threshold, resource_templates, func, *args):
+    """
+    Returns a generator that does the work of func(*args) on behalf of a cooperative event loop, one of two ways:
+
+    1. By running steps, a generator doing the same work incrementally: it yields None at intervals, each a pause at
+       which the caller can let other work run before resuming it, and finally the result
+    2. If an executor is given (an object with a submit(func, *args) method returning a future, as with a
+       concurrent.futures executor) and the resource_templates tree has more than threshold templates, by submitting
+       func(*args) to it: the generator yields the future, to be resumed when the future is done, and then the result
+
+    Either way, the last value yielded is the result; see result_of().
+    """
+    if executor is not None and sum(1 for rt in resource_templates._walk()) > threshold:
+        future = executor.submit(func, *args)
+        yield future
+        yield future.result()
+    else:
+        for value in steps:
+            yield value
+
+def result_of(steps):
+    """
+    Runs a generator returned by cooperatively() to completion without pausing, returning its result
+    """
+    result = None
+    for result in steps:
+        pass
+    return result
+
+def param_rows(columns):
+    """
+    Returns a generator of params dicts from a dict of equal-length param sequences keyed by param name, i.e. converts
+    columnar params to rows, None values being omitted as absent
+    """
+    names = list(columns)
+    return (dict((name, value) for name, value in zip(names, values) if value is not None)
+            for values in itertools.izip(*[columns[name] for name in names]))
+
+
+# The tree of the current worker process of partial_expand_all(), installed once per worker by its pool initializer
+_worker_templates = None
+_worker_encoding = None
+
+def _init_worker(resource_templates, encoding):
+    global _worker_templates, _worker_encoding
+    _worker_templates = resource_templates
+    _worker_encoding = encoding
+
+def _expand_for_worker(task):
+    actual_params, format = task
+    expanded = _worker_templates.partial_expand(actual_params, encoding=_worker_encoding)
+    if format is None:
+        return expanded.to_list()
+    return ''.join(expanded.stream(format))
+
+def partial_expand_all(resource_templates, param_sets, format='json', processes=None, chunksize=None,
+                       encoding=urllib.quote):
+    """
+    Partially expands a ResourceTemplates collection with each of the given params dicts in a pool of processes (by
+    default one per CPU), returning a list of their JSON, YAML or XML representations in the order of param_sets, or
+    of lists of dicts (as to_list()) if format is None.  The collection is passed to each worker once, when it starts,
+    rather than with every task; tasks are handed out in chunks (by default about four per worker) to keep the
+    per-task overhead low.  The encoding must be picklable on platforms that don't fork.
+    """
+    pool = multiprocessing.Pool(processes, _init_worker, (resource_templates, encoding))
+    try:
+        return pool.map(_expand_for_worker, [(actual_params, format) for actual_params in param_sets], chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ResourceTemplateMatcher(object):
+    """
+    Reverse routing: finds the ResourceTemplate whose path (its path_template, or failing that the path part of its
+    uri_template) matches a given path or URI, extracting the template's params.  For example:
+
+    >>> matcher = users.matcher()
+    >>> rt, params = matcher.match('/users/dojo.json')
+    >>> rt.name, params
+    ('user', {'user_id': 'dojo', 'format': 'json'})
+
+    Templates are merged into a trie of path segments: segments of literal text are looked up by key, and only the
+    segments containing template expressions are matched by regex, these being shared by templates with the same
+    expressions at the same position, and grouped by their literal prefix and suffix (the text before the first
+    expression and after the last) so that only those whose prefix and suffix a segment has are tried.  The cost of a
+    match therefore depends on the depth of the tree rather than its size, except where many siblings differ only in
+    their expressions, or have literal prefixes and suffixes of many different lengths, all of which are tried in
+    turn.  Literal segments take priority over expressions; otherwise templates are tried in tree order.  Where an
+    operator's arg contains a '/' (e.g. {-list|/|parts}), the rest of the path is matched by a single regex.
+
+    A query string is split off before the path is matched.  It is matched against the query part of templates that
+    have one (from the first '?', whether literal or in an operator's arg, e.g. {-opt|?|q}), their params taken from
+    it too, and is otherwise ignored.
+    """
+    def __init__(self, resource_templates=()):
+        self.root = _MatcherNode()
+        self.patterns = 0
+        for rt in resource_templates:
+            self.add(rt)
+            for descendant in rt._children._walk():
+                self.add(descendant)
+
+    def add(self, rt):
+        """
+        Add a single template (without its descendants) to the matcher
+        """
+        template = self.template_path(rt)
+        if not template:
+            return
+        segments, query = self.split_query(uri_template.compile(template).segments)
+        if query:
+            source, captures = uri_template.regex_source(query)
+            query = re.compile(source + '$'), captures
+        else:
+            query = None
+        path_segments = self.path_segments(segments)
+
+        node = self.root
+        for i, segment in enumerate(path_segments):
+            if any(isinstance(s, uri_template.Expression) and s.arg and '/' in s.arg for s in segment):
+                tail = []
+                for j, tail_segment in enumerate(path_segments[i:]):
+                    if j: tail.append('/')
+                    tail.extend(tail_segment)
+                source, captures = uri_template.regex_source(tail)
+                node.tails.append((re.compile(source + '$'), captures, rt, query))
+                return
+            elif all(isinstance(s, basestring) for s in segment):
+                node = node.literals.setdefault(''.join(segment), _MatcherNode())
+            else:
+                source, captures = uri_template.regex_source(segment)
+                key = (source, tuple(captures))
+                child = node.patterns.get(key)
+                if child is None:
+                    child = node.patterns[key] = _MatcherNode(re.compile(source + '$'), captures, self.patterns)
+                    self.patterns += 1
+                    prefix = segment[0] if isinstance(segment[0], basestring) else ''
+                    suffix = segment[-1] if isinstance(segment[-1], basestring) else ''
+                    node.affixes.setdefault((prefix, suffix), []).append(child)
+                    lengths = (len(prefix), len(suffix))
+                    if lengths not in node.affix_lengths:
+                        node.affix_lengths.append(lengths)
+                node = child
+        node.templates.append((rt, query))
+
+    @staticmethod
+    def split_query(segments):
+        """
+        Split compiled template segments into those of the path and those of the query, the latter starting at the
+        first '?' in a literal or an operator's arg
+        """
+        for i, segment in enumerate(segments):
+            if isinstance(segment, uri_template.Expression):
+                if segment.arg and '?' in segment.arg:
+                    return segments[:i], segments[i:]
+            elif '?' in segment:
+                j = segment.index('?')
+                return segments[:i] + [segment[:j]], [segment[j:]] + segments[i + 1:]
+        return segments, []
+
+    @staticmethod
+    def template_path(rt):
+        """
+        Returns the template's path_template, or else the path part of its uri_template (if its scheme and host are
+        literal)
+        """
+        if rt.path_template:
+            return rt.path_template
+        elif rt.uri_template:
+            t = rt.uri_template
+            scheme_end = t.find('://')
+            if scheme_end >= 0:
+                path_start = t.find('/', scheme_end + 3)
+                if path_start >= 0 and '{' not in t[:path_start]:
+                    return t[path_start:]
+
+    @staticmethod
+    def path_segments(segments):
+        """
+        Split compiled template segments into a list of path segments (themselves lists of literals and expressions),
+        dropping the empty segment before the path's leading '/'
+        """
+        path = [[]]
+        for segment in segments:
+            if isinstance(segment, uri_template.Expression):
+                path[-1].append(segment)
+            else:
+                parts = segment.split('/')
+                if parts[0]:
+                    path[-1].append(parts[0])
+                for part in parts[1:]:
+                    path.append([part] if part else [])
+        return path[1:]
+
+    def match(self, path):
+        """
+        Returns a (ResourceTemplate, params) tuple for the first template matching the given path or URI, or None
+        """
+        if '://' in path:
+            parts = urlparse.urlsplit(path)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+        path, sep, query = path.partition('?')
+        return self._match(self.root, path.split('/')[1:], 0, {}, sep + query)
+
+    @staticmethod
+    def _match_query(rt, query, params, query_string):
+        if query is None:
+            return rt, params
+        m = query[0].match(query_string)
+        if m:
+            query_params = dict(params)
+            query_params.update(uri_template.captured_params(query[1], m.groups()))
+            return rt, query_params
+
+    def _match(self, node, parts, i, params, query_string):
+        if i == len(parts):
+            for rt, query in node.templates:
+                result = self._match_query(rt, query, params, query_string)
+                if result:
+                    return result
+        else:
+            part = parts[i]
+            child = node.literals.get(part)
+            if child is not None:
+                result = self._match(child, parts, i + 1, params, query_string)
+                if result:
+                    return result
+            for child in node.candidates(part):
+                m = child.regex.match(part)
+                if m:
+                    child_params = dict(params)
+                    child_params.update(uri_template.captured_params(child.captures, m.groups()))
+                    result = self._match(child, parts, i + 1, child_params, query_string)
+                    if result:
+                        return result
+        if node.tails:
+            rest = '/'.join(parts[i:])
+            for regex, captures, rt, query in node.tails:
+                m = regex.match(rest)
+                if m:
+                    tail_params = dict(params)
+                    tail_params.update(uri_template.captured_params(captures, m.groups()))
+                    result = self._match_query(rt, query, tail_params, query_string)
+                    if result:
+                        return result
+
+
+class _MatcherNode(object):
+    def __init__(self, regex=None, captures=None, order=None):
+        self.regex = regex
+        self.captures = captures
+        self.order = order
+        self.literals = {}
+        self.patterns = {}
+        self.affixes = {}       # (literal prefix, literal suffix) -> pattern nodes
+        self.affix_lengths = [] # the distinct (prefix length, suffix length) pairs of affixes
+        self.tails = []
+        self.templates = []
+
+    def candidates(self, part):
+        """
+        The pattern nodes whose literal prefix and suffix the given path segment has, in the order they were added
+        """
+        candidates = []
+        n = len(part)
+        for prefix_length, suffix_length in self.affix_lengths:
+            if prefix_length + suffix_length <= n:
+                group = self.affixes.get((part[:prefix_length], part[n - suffix_length:]))
+                if group:
+                    candidates.extend(group)
+        if len(self.affix_lengths) > 1:
+            candidates.sort(key=lambda node: node.order)
+        return candidates
+
+
+if __name__ == "__main__":
+    import copy
+    import os
+    import pickle
+    import tempfile
+    import unittest
+
+    data = \
+        [
+            {
+                'name':               'users',
+                'uri_template':       'http://example.com/users{-prefix|.|format}',
+                'optional_params':    ['format'],
+                'options':            ['GET', 'POST'],
+                'resource_templates': [
+                    {
+                        'name':               'new_user',
                         'rel':                'new',
                         'uri_template':       'http://example.com/users/new{-prefix|.|format}',
                         'optional_params':    ['format'],
@@ -298,6 +2240,9 @@ if __name__ == "__main__":
     def find_by_name(name):
         return resource_templates.all_by_name()[name]
 
+    class CustomResourceTemplate(ResourceTemplate):
+        __slots__ = ()
+
     class TestResourceTemplate(unittest.TestCase):
         def test_find_by_rel(self):
             user = find_by_name('user')
@@ -308,10 +2253,57 @@ if __name__ == "__main__":
             user = find_by_name('user')
             self.assertEqual('http://example.com/users/dojo.json', user.uri_for(params))
             
+        def test_uris_for(self):
+            user = find_by_name('user')
+            self.assertEqual(
+                ['http://example.com/users/dojo.json', 'http://example.com/users/kyu'],
+                list(user.uris_for([params, {'user_id': 'kyu'}])))
+            self.assertEqual(
+                ['http://example.com/users/dojo.json', 'http://example.com/users/kyu.xml'],
+                list(user.uris_for_columns({'user_id': ['dojo', 'kyu'], 'format': ['json', 'xml']})))
+            self.assertRaises(KeyError, list, user.uris_for([params, {'format': 'json'}]))
+            self.assertRaises(KeyError, user.uris_for_columns, {'format': ['json']})
+            self.assertRaises(KeyError, user.uris_for_columns, {'user_id': ['dojo', None]})
+            self.assertEqual(['http://example.com/users/dojo'], user.uris_for_columns({'user_id': ('dojo',), 'format': [None]}))
+
+        def test_collection_uris_for(self):
+            user = find_by_name('user')
+            self.assertEqual(
+                [
+                    {'edit_user': 'http://example.com/users/dojo/edit.json',
+                     'user_articles': 'http://example.com/users/dojo/articles.json'},
+                    {}
+                ],
+                list(user.resource_templates.uris_for([params, {'format': 'json'}])))
+            self.assertEqual(
+                list(user.resource_templates.uris_for([params, {'format': 'json'}])),
+                list(user.resource_templates.uris_for_columns({'user_id': ['dojo', None], 'format': ['json', 'json']})))
+
+        def test_encoding(self):
+            user_article = find_by_name('user_article')
+            quote = uri_template.quoter()
+            actual_params = {'user_id': 'dojo', 'article_id': 'a b'}
+            self.assertEqual('http://example.com/users/dojo/articles/a%20b', user_article.uri_for(actual_params, encoding=quote))
+            self.assertEqual('http://example.com/users/dojo/articles/a%20b', user_article.uri_for(actual_params, encoding=quote))
+            self.assertEqual((2, 2, 1), quote.info()[:3])
+            self.assertEqual(
+                'http://example.com/users/dojo/articles/a_b{-prefix|.|format}',
+                user_article.partial_expand(actual_params, lazy=True, encoding=lambda s: s.replace(' ', '_')).uri_template)
+
         def test_uri_based_on_path(self):
             user = find_by_name('test_with_no_uri_template')
             self.assertEqual('http://example.com/base/path', user.uri_for({}, 'http://example.com/base'))
             
+        def test_path_for(self):
+            user = find_by_name('test_with_no_uri_template')
+            self.assertEqual('/path', user.path_for({}))
+
+        def test_compiled_template(self):
+            user = find_by_name('user')
+            compiled = user.compiled_template('uri_template')
+            self.assertTrue(compiled is user.compiled_template('uri_template'))
+            self.assertEqual(None, user.compiled_template('path_template'))
+
         def test_partial_expand(self):
             user_articles = find_by_name('user_articles')
             self.assertEqual(
@@ -331,6 +2323,338 @@ if __name__ == "__main__":
                 },
                 user_articles.partial_expand(params).to_dict())
         
+        def test_partial_expand_all(self):
+            param_sets = [{'user_id': user_id, 'format': 'json'} for user_id in ('a', 'b', 'c', 'd', 'e')]
+            self.assertEqual(
+                [resource_templates.partial_expand(p).to_list() for p in param_sets],
+                resource_templates.partial_expand_all(param_sets, format=None, processes=2))
+            self.assertEqual(
+                [''.join(resource_templates.partial_expand(p).stream('yaml')) for p in param_sets],
+                partial_expand_all(resource_templates, param_sets, 'yaml', processes=2, chunksize=1))
+
+        def test_snapshot(self):
+            templates = ResourceTemplates(data + [{'name': u'caf\xe9', 'params': ['format']}])
+            snapshot = Snapshot(''.join(templates.stream('snapshot')))
+            self.assertEqual(templates.to_list(), snapshot.resource_templates().to_list())
+            article = snapshot.resource_templates()[0].resource_templates[1].resource_templates[1].resource_templates[0]
+            self.assertEqual(frozenset(['user_id']), article.inherited_param_set)
+            article.params = ['user_id', 'other']
+            self.assertEqual(frozenset(['user_id', 'other']), article.param_set)
+            handle, filename = tempfile.mkstemp()
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    resource_templates.write(f, 'snapshot')
+                loaded = load_snapshot(filename)
+                user = loaded[0].resource_templates[1]
+                self.assertEqual('user', user.name)
+                self.assertTrue(user.params is user.resource_templates[0].params)
+                self.assertEqual(find_by_name('user').partial_expand(params).to_dict(), user.partial_expand(params).to_dict())
+                self.assertEqual(resource_templates.to_list(), loaded.to_list())
+            finally:
+                os.remove(filename)
+
+        def test_instrumentation(self):
+            user = find_by_name('user')
+            instrumentation = uri_template.instrument()
+            try:
+                user.uri_for(params)
+                user.uri_for(params)
+                user.partial_expand(params)
+                listed = resource_templates.to_list()
+                resource_templates.all_by_name()
+            finally:
+                uri_template.uninstrument()
+            user.uri_for(params)
+            report = instrumentation.report()
+            self.assertEqual(
+                [('all_by_name', None), ('partial_expand', 'user'), ('to_list', None), ('uri_for', 'user')],
+                sorted(report))
+            self.assertEqual(2, report[('uri_for', 'user')].count)
+            self.assertEqual(1, report[('partial_expand', 'user')].count)
+            self.assertEqual(len(resource_templates.all_by_name()), report[('all_by_name', None)].size)
+            self.assertEqual(len(list(resource_templates._walk())), report[('to_list', None)].size)
+            self.assertEqual(resource_templates.to_list(), listed)
+
+        def test_static(self):
+            self.assertEqual(['test_with_no_uri_template'], [rt.name for rt in resource_templates.static_templates()])
+            self.assertFalse(find_by_name('new_user').is_static)
+            static = ResourceTemplate(name='new_user', uri_template='http://example.com/users/new', path_template='/users/new')
+            self.assertTrue(static.is_static)
+            self.assertEqual('http://example.com/users/new', static.uri_for({}, 'http://example.org'))
+            self.assertEqual('/users/new', static.path_for({}))
+            path_only = find_by_name('test_with_no_uri_template')
+            self.assertEqual('http://example.com/base/path', path_only.uri_for({}, 'http://example.com/base'))
+            self.assertEqual({'http://example.com/base': 'http://example.com/base/path'}, path_only._static[2])
+            self.assertRaises(RuntimeError, path_only.uri_for, {})
+            path_only.path_template = '/{path}'
+            self.assertFalse(path_only.is_static)
+            path_only.path_template = '/path'
+
+        def test_cooperative(self):
+            steps = list(resource_templates.partial_expand_steps(params, step=2))
+            self.assertEqual([None, None, None], steps[:-1])
+            self.assertEqual(resource_templates.partial_expand(params).to_list(), steps[-1].to_list())
+            user = steps[-1].all_by_name()['user']
+            self.assertTrue(user.resource_templates[0].parent is user)
+            self.assertEqual(resource_templates.to_list(), result_of(resource_templates.to_list_steps(step=1)))
+
+            class Future(object):
+                def __init__(self, result):
+                    self._result = result
+                def result(self):
+                    return self._result
+
+            class Executor(object):
+                def submit(self, func, *args):
+                    return Future(func(*args))
+
+            steps = list(resource_templates.to_list_steps(executor=Executor(), threshold=5))
+            self.assertTrue(isinstance(steps[0], Future))
+            self.assertEqual([resource_templates.to_list()], steps[1:])
+            steps = list(resource_templates.to_list_steps(executor=Executor(), threshold=100))
+            self.assertEqual([resource_templates.to_list()], steps)
+
+        def test_diff(self):
+            tree = ResourceTemplates(data).memoize_partial_expansions()
+            tree.get_index()
+            user, edit_user = tree.all_by_name()['user'], tree.all_by_name()['edit_user']
+            edit_user.memoize_partial_expansions()
+            expanded, edit_expanded = tree.partial_expand(params), edit_user.partial_expand(params)
+
+            changed = copy.deepcopy(data)
+            user_data = changed[0]['resource_templates'][1]
+            user_data['options'] = ['GET', 'PUT']
+            del user_data['resource_templates'][1]
+            user_data['resource_templates'].append({'name': 'delete_user', 'rel': 'delete', 'params': ['user_id']})
+            other = ResourceTemplates(changed)
+            self.assertEqual(other.structural_hash(), ResourceTemplates(changed).structural_hash())
+            self.assertNotEqual(other.structural_hash(), tree.structural_hash())
+
+            diff = tree.update(other)
+            self.assertEqual([(user, 1, other.all_by_name()['delete_user'])], diff.added)
+            self.assertEqual(['user_articles'], [rt.name for rt in diff.removed])
+            self.assertEqual([(user, other.all_by_name()['user'])], diff.changed)
+            self.assertEqual(other.to_list(), tree.to_list())
+            self.assertEqual(other.structural_hash(), tree.structural_hash())
+            self.assertEqual(TreeDiff([], [], []), tree.diff(other))
+
+            self.assertTrue('delete_user' in tree.all_by_name())
+            self.assertFalse('user_article' in tree.all_by_name())
+            self.assertEqual(('GET', 'PUT'), tree.all_by_name()['user'].options)
+            self.assertEqual(['delete_user'], [rt.name for rt in user.find_by_rel('delete')])
+            self.assertFalse(expanded is tree.partial_expand(params))
+            self.assertTrue(edit_expanded is edit_user.partial_expand(params))
+
+        def test_pickle(self):
+            memoized = ResourceTemplates(data).memoize_partial_expansions()
+            memoized.partial_expand(params)
+            unpickled = pickle.loads(pickle.dumps(memoized, 2))
+            self.assertEqual(resource_templates.to_list(), unpickled.to_list())
+            user_article = unpickled.all_by_name()['user_article']
+            self.assertTrue(user_article in user_article.parent.resource_templates)
+            self.assertEqual('user', user_article.parent.parent.name)
+            self.assertTrue(EMPTY is user_article._children)
+            self.assertEqual('http://example.com/users/dojo/articles/1.json', user_article.uri_for(dict(params, article_id='1')))
+            custom = pickle.loads(pickle.dumps(CustomResourceTemplate(name='custom', uri_template='/custom'), 2))
+            self.assertEqual((CustomResourceTemplate, '/custom'), (type(custom), custom.uri_for({})))
+            lazy = pickle.loads(pickle.dumps(find_by_name('user_article').partial_expand(params, lazy=True), 2))
+            self.assertEqual(ResourceTemplate, type(lazy))
+
+        def test_stream_json(self):
+            self.assertEqual(resource_templates.to_list(), json.loads(''.join(resource_templates.stream())))
+            user = find_by_name('user')
+            self.assertEqual(user.to_dict(), json.loads(''.join(user.stream('json'))))
+
+        def test_cached_json(self):
+            tree = ResourceTemplates(data)
+            self.assertEqual(''.join(tree.stream()), tree.to_json())
+            self.assertEqual(tree.to_json(), tree.to_json(cache=True))
+            users = tree[0]
+            user_articles = tree.all_by_name()['user_articles']
+            cached = user_articles.resource_templates._json
+            self.assertTrue(cached is not None)
+            self.assertEqual(''.join(users.stream()), users.to_json(cache=True))
+
+            user = tree.all_by_name()['user']
+            user.resource_templates.append(ResourceTemplate(name='delete_user', rel='delete'))
+            self.assertEqual(''.join(tree.stream()), tree.to_json(cache=True))
+            self.assertTrue('delete_user' in tree.to_json(cache=True))
+            self.assertTrue(cached is user_articles.resource_templates._json)
+            self.assertEqual(json.loads(tree.to_json()), tree.to_list())
+
+            user.options = ['GET', 'PATCH']
+            self.assertTrue('PATCH' in ''.join(tree.stream()))
+            self.assertTrue('PATCH' in tree.to_json())
+            self.assertEqual(json.loads(tree.to_json(cache=True)), tree.to_list())
+            top = tree[-1]
+            tree.to_json(cache=True)
+            top.path_template = '/other_path'
+            self.assertTrue('/other_path' in tree.to_json(cache=True))
+
+            view = ResourceTemplates([user])
+            view.to_json(cache=True)
+            view.structural_hash()
+            self.assertEqual(None, view._index)
+            user.resource_templates.append(ResourceTemplate(name='x_user'))
+            self.assertTrue('x_user' in tree.all_by_name())
+            self.assertTrue('x_user' in view.to_json(cache=True))
+
+        def test_stream_yaml(self):
+            user_articles = find_by_name('user_articles')
+            self.assertEqual(
+                '- name: "user_articles"\n' +
+                '  rel: "articles"\n' +
+                '  uri_template: "http://example.com/users/{user_id}/articles{-prefix|.|format}"\n' +
+                '  params: ["user_id"]\n' +
+                '  optional_params: ["format"]\n' +
+                '  options: ["GET", "POST"]\n' +
+                '  resource_templates:\n' +
+                '    - name: "user_article"\n' +
+                '      uri_template: "http://example.com/users/{user_id}/articles/{article_id}{-prefix|.|format}"\n' +
+                '      params: ["user_id", "article_id"]\n' +
+                '      optional_params: ["format"]\n' +
+                '      options: ["GET", "PUT", "DELETE"]\n',
+                ''.join(ResourceTemplates([user_articles]).stream('yaml')))
+
+        def test_stream_xml(self):
+            from xml.dom import minidom
+            import StringIO
+            out = StringIO.StringIO()
+            resource_templates.write(out, 'xml')
+            doc = minidom.parseString(out.getvalue())
+            self.assertEqual(
+                sorted(resource_templates.all_by_name()),
+                sorted(e.firstChild.data for e in doc.getElementsByTagName('name')))
+            user = doc.getElementsByTagName('ResourceTemplate')[2]
+            self.assertEqual('user_id', user.getElementsByTagName('Params')[0].getElementsByTagName('param')[0].firstChild.data)
+            self.assertEqual('GET, PUT, DELETE', user.getElementsByTagName('options')[0].firstChild.data)
+
+        def test_lazy_partial_expand(self):
+            user_articles = find_by_name('user_articles')
+            lazy = user_articles.partial_expand(params, lazy=True)
+            self.assertFalse('__children' in lazy.__dict__)
+            self.assertEqual(user_articles.partial_expand(params).to_dict(), lazy.to_dict())
+            self.assertEqual('user_articles', lazy.resource_templates[0].parent.name)
+
+            self.assertEqual(
+                resource_templates.partial_expand(params).to_list(),
+                resource_templates.partial_expand(params, lazy=True).to_list())
+            self.assertEqual(
+                'http://example.com/users/dojo/articles/1.json',
+                lazy.partial_expand({'article_id': '1'}, lazy=True).resource_templates[0].uri_template)
+
+            bound = dict(params)
+            user = find_by_name('user').partial_expand(bound, lazy=True)
+            bound['user_id'] = 'kyu'
+            self.assertEqual('http://example.com/users/dojo.json', user.uri_template)
+
+            article = lazy.resource_templates[0]
+            self.assertEqual(frozenset(['article_id']), article.param_set)
+            self.assertEqual(frozenset(), article.inherited_param_set)
+            article.params = ['other']
+            self.assertEqual(frozenset(['other']), article.param_set)
+            self.assertTrue(article.params is ResourceTemplate(params=['other']).params)
+            sets = len(vocabulary.sets)
+            for i in range(10):
+                article.params = ['other']
+                article.param_set
+            self.assertEqual(sets, len(vocabulary.sets))
+            article.optional_params = []
+            self.assertEqual(frozenset(), article.optional_param_set)
+
+        def test_lazy_partial_expand_sharing(self):
+            user = find_by_name('user')
+            lazy = user.partial_expand({'article_id': '1'}, lazy=True)
+            self.assertTrue(lazy.uri_template is user.uri_template)
+            self.assertTrue(lazy.params is user.params)
+            self.assertTrue(lazy.compiled_template('uri_template') is user.compiled_template('uri_template'))
+            self.assertEqual(
+                'http://example.com/users/{user_id}/articles/1{-prefix|.|format}',
+                lazy.find_by_rel('articles')[0].resource_templates[0].uri_template)
+
+        def test_memoized_partial_expansions(self):
+            tree = ResourceTemplates(data).memoize_partial_expansions(maxsize=2)
+            expanded = tree.partial_expand(params)
+            self.assertTrue(expanded is tree.partial_expand({'format': 'json', 'user_id': 'dojo'}))
+            self.assertFalse(expanded is tree.partial_expand(params, lazy=True))
+
+            user = tree.all_by_name()['user']
+            user.resource_templates.append(ResourceTemplate(name='delete_user', rel='delete'))
+            self.assertFalse(expanded is tree.partial_expand(params))
+            self.assertTrue('delete_user' in tree.partial_expand(params).all_by_name())
+
+            self.assertEqual(PartialExpansionInfo(2, 3, 0, 2, 1, 1), tree.partial_expansion_info())
+            self.assertEqual(None, user.partial_expansion_info())
+
+        def test_memoized_template_partial_expansions(self):
+            user = ResourceTemplates(data).all_by_name()['user'].memoize_partial_expansions()
+            self.assertTrue(user.partial_expand(params) is user.partial_expand(params))
+            self.assertEqual(1, user.partial_expansion_info().hits)
+            user.options = ['GET']
+            self.assertEqual(('GET',), user.partial_expand(params).options)
+            user.resource_templates[0].options = ['PUT']
+            self.assertEqual(('PUT',), user.partial_expand(params).resource_templates[0].options)
+
+            tree = ResourceTemplates(data)
+            leaf = tree.all_by_name()['edit_user'].memoize_partial_expansions()
+            self.assertTrue(leaf.partial_expand(params) is leaf.partial_expand(params))
+            self.assertTrue(leaf._children is EMPTY)
+            tree.get_index()
+            leaf.resource_templates.append(ResourceTemplate(name='leaf_child'))
+            self.assertTrue('leaf_child' in tree.all_by_name())
+            self.assertEqual(['leaf_child'], [rt.name for rt in leaf.partial_expand(params).resource_templates])
+
+            tree = ResourceTemplates(data).memoize_partial_expansions()
+            user_article = tree.all_by_name()['user_article']
+            tree.partial_expand(params)
+            user_article.options = ['GET']
+            self.assertEqual(('GET',), tree.partial_expand(params).all_by_name()['user_article'].options)
+
+        def test_compact_representation(self):
+            user_article = find_by_name('user_article')
+            self.assertFalse(hasattr(user_article, '__dict__'))
+            self.assertEqual(('GET', 'PUT', 'DELETE'), user_article.options)
+            self.assertTrue(find_by_name('test_with_no_uri_template')._children is EMPTY)
+            self.assertRaises(TypeError, EMPTY.append, user_article)
+
+            leaf = ResourceTemplates(data).all_by_name()['user_article']
+            self.assertTrue(leaf._children is EMPTY)
+            leaf.resource_templates.append(ResourceTemplate(name='edit_user_article', rel='edit'))
+            self.assertEqual(['edit_user_article'], [rt.name for rt in leaf.find_by_rel('edit')])
+            self.assertFalse(EMPTY)
+
+        def test_param_sets(self):
+            user_articles = find_by_name('user_articles')
+            user_article = find_by_name('user_article')
+            self.assertEqual(frozenset(['user_id', 'article_id']), user_article.param_set)
+            self.assertEqual(frozenset(['format']), user_article.optional_param_set)
+            self.assertEqual(frozenset(['user_id']), user_article.inherited_param_set)
+            self.assertTrue(user_article.has_params({'user_id': 1, 'article_id': 2}))
+            self.assertFalse(user_article.has_params({'user_id': 1}))
+            self.assertEqual(['article_id'], user_article.missing_params({'user_id': 1}))
+            self.assertRaises(KeyError, user_article.uri_for, {'user_id': 1})
+
+        def test_vocabulary(self):
+            resource_templates = ResourceTemplates(data)
+            users = resource_templates.all_by_name()
+            self.assertTrue(users['user_articles'].optional_params is users['user_article'].optional_params)
+            self.assertTrue(users['user_articles'].optional_param_set is users['user_article'].optional_param_set)
+            copy = ResourceTemplates(data).all_by_name()['user_article']
+            self.assertTrue(copy.params is users['user_article'].params)
+            self.assertTrue(copy.name is users['user_article'].name)
+            expanded = users['user_article'].partial_expand({'user_id': 'dojo'})
+            self.assertTrue(expanded.params is ResourceTemplate(params=['article_id']).params)
+            self.assertEqual(unicode, type(ResourceTemplate(params=[u'article_id']).params[0]))
+
+            report = resource_templates.memory_report()
+            self.assertEqual(len(list(resource_templates._walk())), report.nodes)
+            self.assertTrue(report.distinct_values < report.values)
+            self.assertTrue(sum(report.attribute_bytes.values()) < report.bytes)
+            subtree = users['user_articles'].resource_templates
+            copy = ResourceTemplates(subtree.to_list())
+            copy[0].partial_expand({'user_id': 'dojo'})
+            self.assertEqual(copy.memory_report(), subtree.memory_report()) # not reaching the rest through the index
+
         def test_positional_params(self):
             user_articles = find_by_name('user_articles')
             user_article = find_by_name('user_article')
@@ -344,11 +2668,123 @@ if __name__ == "__main__":
                     '  {article_id}         user_article  GET, PUT, DELETE http://example.com/users/{user_id}/articles/{article_id}{-prefix|.|format}\n',
                      str(user_articles))
 
+        def test_text_lines(self):
+            self.assertEqual(
+                ['users                     users                     GET, POST        http://example.com/users{-prefix|.|format}\n',
+                 '  new                     new_user                  GET              http://example.com/users/new{-prefix|.|format}\n',
+                 '  {user_id}               user                      GET, PUT, DELETE http://example.com/users/{user_id}{-prefix|.|format}\n',
+                 'test_with_no_uri_template test_with_no_uri_template                  /path\n'],
+                list(resource_templates.text_lines(depth=2)))
+            import StringIO
+            out = StringIO.StringIO()
+            resource_templates.write_text(out, name_prefix='user_art')
+            self.assertEqual(str(find_by_name('user_articles')), out.getvalue())
+
+            tree = ResourceTemplates(data)
+            tree.get_index()
+            user = tree.all_by_name()['user']
+            str(user)
+            user.resource_templates.append(ResourceTemplate(name='user_report'))
+            self.assertTrue('user_report' in tree.all_by_name())
+            self.assertTrue('user_report' in str(tree))
+
         def test_parent(self):
             user_articles = find_by_name('user_articles')
             self.assertEqual('user', user_articles.parent.name)
             self.assertEqual('users', user_articles.parent.parent.name)
-            self.assertNone(user_articles.parent.parent.parent)
+            self.assertIsNone(user_articles.parent.parent.parent)
+
+        def test_index(self):
+            tree = ResourceTemplates(data)
+            by_name = tree.all_by_name()
+            del by_name['user']
+            self.assertTrue('user' in tree.all_by_name())
+            user = tree.find_by_name('user')
+            self.assertTrue(user is tree.all_by_name()['user'])
+            self.assertEqual('user_article', user.resource_templates.find_by_name('user_article').name)
+            self.assertEqual(None, tree.find_by_name('missing'))
+            self.assertEqual([tree.all_by_name()['edit_user']], tree.all_by_rel('edit'))
+
+            user.resource_templates.append(ResourceTemplate(name='delete_user', rel='delete'))
+            self.assertEqual('delete_user', tree.all_by_name()['delete_user'].name)
+            self.assertEqual(['delete_user'], [rt.name for rt in user.find_by_rel('delete')])
+
+            del user.resource_templates[-1]
+            self.assertFalse('delete_user' in tree.all_by_name())
+            self.assertEqual([], user.find_by_rel('delete'))
+
+            self.assertTrue('user_article' in tree.partial_expand(params).all_by_name())
+
+            json_before = tree.to_json(cache=True)
+            user.resource_templates = ResourceTemplates([{'name': 'replaced'}], user)
+            self.assertTrue('replaced' in tree.all_by_name())
+            self.assertFalse('edit_user' in tree.all_by_name())
+            self.assertNotEqual(json_before, tree.to_json(cache=True))
+            self.assertEqual(json.loads(tree.to_json(cache=True)), tree.to_list())
+            self.assertTrue(user.resource_templates[0]._collection is user.resource_templates)
+
+            leaf = tree[-1]
+            self.assertFalse(leaf._children)
+            leaf.resource_templates.append(ResourceTemplate(name='leaf_child'))
+            self.assertTrue('leaf_child' in tree.all_by_name())
+            tree.remove(leaf)
+            self.assertTrue(leaf._collection is None)
+            self.assertFalse('leaf_child' in tree.all_by_name())
+
+        def test_matcher(self):
+            tree = ResourceTemplates(data + [
+                {'name': 'file', 'path_template': '/files{-prefix|/|dir}/{-list|/|parts}', 'params': ['parts']},
+                {'name': 'search', 'path_template': '/search{-opt|?|q,num}{-join|&|q,num}', 'optional_params': ['q', 'num']}])
+            matcher = tree.matcher()
+            def match(path):
+                rt, params = matcher.match(path)
+                return rt.name, params
+            self.assertEqual(('user', {'user_id': 'dojo', 'format': 'json'}), match('/users/dojo.json'))
+            self.assertEqual(('user', {'user_id': 'dojo'}), match('http://example.com/users/dojo'))
+            self.assertEqual(('new_user', {}), match('/users/new'))
+            self.assertEqual(('user_article', {'user_id': 'dojo', 'article_id': 'a b'}), match('/users/dojo/articles/a%20b'))
+            self.assertEqual(('test_with_no_uri_template', {}), match('/path'))
+            self.assertEqual(('file', {'dir': 'a', 'parts': ['b', 'c']}), match('/files/a/b/c'))
+            self.assertEqual(('search', {'q': 'x', 'num': '10'}), match('/search?q=x&num=10'))
+            self.assertEqual(None, matcher.match('/users/dojo/unknown'))
+            self.assertEqual(('user', {'user_id': 'dojo'}), match('http://example.com/users/dojo?page=2'))
+            self.assertEqual(('user', {'user_id': 'dojo', 'format': 'json'}), match('/users/dojo.json?page=2'))
+            self.assertEqual(('search', {'q': 'x'}), match('/search?q=x'))
+            self.assertEqual(('search', {}), match('/search'))
+
+            siblings = ResourceTemplates([{'name': 'item_%d' % i, 'path_template': '/items/i%d-{id}' % i, 'params': ['id']}
+                                          for i in range(100)] +
+                                         [{'name': 'item', 'path_template': '/items/{id}', 'params': ['id']}])
+            matcher = siblings.matcher()
+            self.assertEqual(('item_42', {'id': '7'}), match('/items/i42-7'))
+            self.assertEqual(('item', {'id': 'x7'}), match('/items/x7'))
+            self.assertEqual(2, len(matcher.root.literals['items'].candidates('i42-7')))
+
+        def test_frozen_index(self):
+            tree = ResourceTemplates(data).freeze()
+            user = tree.all_by_name()['user']
+            user.resource_templates.append(ResourceTemplate(name='delete_user', rel='delete'))
+            self.assertFalse('delete_user' in tree.all_by_name())
+            self.assertEqual(['delete_user'], [rt.name for rt in user.find_by_rel('delete')])
+            tree.thaw()
+            self.assertTrue('delete_user' in tree.all_by_name())
+
+            tree.freeze()
+            user.resource_templates = [{'name': 'replaced', 'resource_templates': [{'name': 'replaced_child'}]}]
+            replaced = user.resource_templates[0]
+            self.assertTrue(replaced.resource_templates._index is tree._index)
+            tree.thaw()
+            self.assertTrue('replaced_child' in tree.all_by_name())
+            self.assertFalse('edit_user' in tree.all_by_name())
+
+            tree.freeze()
+            other = ResourceTemplates(tree.to_list() + [{'name': 'added', 'resource_templates': [{'name': 'child'}]}])
+            tree.update(other)
+            self.assertTrue(tree[-1].resource_templates._index is tree._index)
+            user.resource_templates.append(ResourceTemplate(name='appended', resource_templates=[{'name': 'child'}]))
+            user.resource_templates.insert(0, ResourceTemplate(name='inserted', resource_templates=[{'name': 'child'}]))
+            self.assertTrue(user.resource_templates[0].resource_templates._index is tree._index)
+            self.assertTrue(user.resource_templates[-1].resource_templates._index is tree._index)
 
 
     unittest.main()
@@ -1,5 +1,10 @@
 import urllib
 import re
+import bisect
+import collections
+import itertools
+import threading
+import time
 
 '''
 Regexp-based implementation of URI Templates v3.
@@ -8,6 +13,8 @@ Features:
 
 1) A partial expansion mode inspired by sporkonger/addressable (rubygem)
 2) Overridable quoting of special charactors
+3) Compiled templates (see compile()), with a bounded LRU cache of them behind sub() (see set_cache_size() and cache_info())
+4) Opt-in counters and latency histograms for sub() and the described_routes hot paths (see instrument())
 
 Usage:
 
@@ -27,16 +34,539 @@ Mike Burrows (asplake), email mailto:mjb@asplake.co.uk, website http://positivei
 '''
 
 def sub(template, params, encoding=urllib.quote, partial=False):
-    return re.sub(r'{(-)?([^}]+)}', lambda match: matched(match, params, encoding, partial), template)
+    if instrumentation is None:
+        return cached(template)._expand(params, encoding, partial)
+    return instrumentation.call('sub', template, cached(template)._expand, (params, encoding, partial))
 
 def matched(match, params, encoding, partial):
-    is_operator, body = match.groups()
+    return parse_expression(*match.groups()).expand(params, encoding, partial)
+
+def compile(template):
+    """
+    Parse a template once, returning a Template object that can be expanded many times
+    """
+    return Template(template)
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
+class LRUCache(object):
+    """
+    A thread-safe mapping bounded to maxsize entries (None for unbounded), evicting the least recently used
+    entries first and keeping hit, miss and eviction counts.  With a ttl (in seconds), entries also expire that long
+    after being set, counting as evictions when found to have expired.
+    """
+    def __init__(self, maxsize=None, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if entry[1] is not None and entry[1] <= self.timer():
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, self.timer() + self.ttl if self.ttl is not None else None)
+            self._evict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self, keep_stats=False):
+        with self._lock:
+            self._data.clear()
+            if not keep_stats:
+                self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._data))
+
+    def _evict(self):
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+DEFAULT_CACHE_SIZE = 512
+
+cache = LRUCache(DEFAULT_CACHE_SIZE)
+
+def cached(template):
+    """
+    Like compile(), but reusing previously compiled templates from the process-wide cache
+    """
+    compiled = cache.get(template)
+    if compiled is None:
+        compiled = cache[template] = compile(template)
+    return compiled
+
+NUMBERS = (int, long, float)
+STRINGS = frozenset([str, unicode, type(None)])
+
+class MemoizedEncoding(object):
+    """
+    A version of the given encoding function that encodes each distinct value only once (converting numbers to
+    strings before the lookup, so that 1, 1.0 and True don't share an entry), keeping up to maxsize encoded values
+    (None for unbounded).  When full, it evicts an arbitrary entry rather than the least recently used, sparing its
+    hits the bookkeeping of an LRUCache.  Its info() returns counts of cache hits, misses and evictions, and clear()
+    empties the cache and resets the counts.
+    """
+    def __init__(self, encoding, maxsize=None):
+        self.encoding = encoding
+        self.maxsize = maxsize
+        self.encoded = {None: None}
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, value):
+        if value.__class__ is not str and isinstance(value, NUMBERS):
+            value = str(value)
+        try:
+            result = self.encoded[value]
+        except KeyError:
+            return self._miss(value)
+        except TypeError: # unhashable
+            return self.encoding(value)
+        self.hits += 1
+        return result
+
+    def _miss(self, value):
+        self.misses += 1
+        result = self.encoding(value)
+        encoded = self.encoded
+        maxsize = self.maxsize
+        if maxsize is not None and len(encoded) > maxsize: # not counting None
+            if not maxsize:
+                return result
+            key, _ = encoded.popitem()
+            if key is None:
+                encoded.popitem()
+                encoded[None] = None
+            self.evictions += 1
+        encoded[value] = result
+        return result
+
+    def column(self, values):
+        """
+        Returns the list of encodings of the given values, None for None
+        """
+        if self.maxsize is not None:
+            return [self(value) for value in values]
+        if not STRINGS.issuperset(set(map(type, values))):
+            values = [str(value) if isinstance(value, NUMBERS) else value for value in values]
+        encoded = self.encoded
+        try:
+            for value in set(values).difference(encoded):
+                self._miss(value)
+        except TypeError: # unhashable
+            return [self(value) for value in values]
+        return map(encoded.__getitem__, values)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.encoded) - 1)
+
+    def clear(self):
+        self.encoded = {None: None}
+        self.hits = self.misses = self.evictions = 0
+
+QuoterInfo = collections.namedtuple('QuoterInfo', 'hits misses safe evictions maxsize currsize')
+
+class Quoter(MemoizedEncoding):
+    """
+    A MemoizedEncoding of urllib.quote with the given safe characters, returning values that consist only of safe
+    characters (as checked by a precompiled regex) as they are.  Its info() also counts how many of the misses were
+    safe values.
+    """
+    def __init__(self, safe='/', maxsize=10000):
+        MemoizedEncoding.__init__(self, self.quote, maxsize)
+        self.safe = safe
+        self.safe_values = 0
+        self.is_safe = re.compile('[A-Za-z0-9_.%s-]*\\Z' % re.escape(safe)).match
+
+    def quote(self, value):
+        if self.is_safe(value):
+            self.safe_values += 1
+            return value
+        return urllib.quote(value, self.safe)
+
+    def info(self):
+        return QuoterInfo(self.hits, self.misses, self.safe_values, self.evictions, self.maxsize,
+                          len(self.encoded) - 1)
+
+    def clear(self):
+        MemoizedEncoding.clear(self)
+        self.safe_values = 0
+
+def quoter(safe='/', maxsize=10000):
+    """
+    Returns an encoding function for use in place of urllib.quote (the default encoding of sub(), Template.expand()
+    etc), memoizing its results for up to maxsize distinct values; see Quoter
+    """
+    return Quoter(safe, maxsize)
+
+quote = quoter()
+
+def column_values(values):
+    """
+    Returns a column's values as a list or tuple, converting NumPy arrays (or anything else with a tolist() method)
+    and other iterables
+    """
+    if isinstance(values, (list, tuple)):
+        return values
+    elif hasattr(values, 'tolist'):
+        return values.tolist()
+    else:
+        return list(values)
+
+def set_cache_size(maxsize):
+    """
+    Set the maximum number of compiled templates kept by the process-wide cache (None for unbounded)
+    """
+    cache.resize(maxsize)
+
+def cache_info():
+    """
+    Hit, miss and eviction statistics for the process-wide cache of compiled templates
+    """
+    return cache.info()
+
+def clear_cache():
+    cache.clear()
+
+OperationStats = collections.namedtuple('OperationStats', 'count seconds max_seconds size histogram')
+
+class Instrumentation(object):
+    """
+    Counts and times the calls of instrumented operations, keyed by operation and template (the template's name for
+    described_routes operations, or the name of the collection's parent; its text for sub()).  Each operation's
+    latencies are kept as a histogram of counts per bucket, the buckets bounded above by BUCKETS (in seconds); where
+    an operation reports a size (the number of templates of a tree, for example), sizes are totalled.  Each call is
+    also passed to the sink, if any, as sink(operation, key, seconds, size).
+    """
+    BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 1.0,
+               float('inf'))
+
+    def __init__(self, sink=None, timer=time.time):
+        self.sink = sink
+        self.timer = timer
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    def call(self, operation, key, func, args, size=None):
+        """
+        Returns func(*args), recording the call unless it is nested within another of the same operation (which then
+        accounts for it), with a size of size(result) if size is given
+        """
+        active = self._active.__dict__
+        if operation in active:
+            return func(*args)
+        active[operation] = True
+        try:
+            start = self.timer()
+            result = func(*args)
+            seconds = self.timer() - start
+        finally:
+            del active[operation]
+        self.record(operation, key, seconds, size(result) if size else None)
+        return result
+
+    def record(self, operation, key, seconds, size=None):
+        with self._lock:
+            stats = self._stats.get((operation, key))
+            if stats is None:
+                stats = self._stats[operation, key] = [0, 0.0, 0.0, 0, [0] * len(self.BUCKETS)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += size or 0
+            stats[4][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        if self.sink is not None:
+            self.sink(operation, key, seconds, size)
+
+    def report(self):
+        """
+        A dict of OperationStats(count, seconds, max_seconds, size, histogram) keyed by (operation, key)
+        """
+        with self._lock:
+            return dict((k, OperationStats(count, seconds, max_seconds, size, tuple(histogram)))
+                        for k, (count, seconds, max_seconds, size, histogram) in self._stats.iteritems())
+
+    def most_called(self, n=10, operation=None):
+        """
+        The n most frequently called (operation, key) pairs, optionally of a single operation, with their stats
+        """
+        report = [(k, stats) for k, stats in self.report().iteritems() if operation in (None, k[0])]
+        return sorted(report, key=lambda item: item[1].count, reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+# The process-wide Instrumentation, or None (the default) for none
+instrumentation = None
+
+def instrument(sink=None, timer=time.time):
+    """
+    Start instrumenting sub() and the described_routes hot paths, returning the new Instrumentation.  Until then,
+    instrumentation costs a single check per call.
+    """
+    global instrumentation
+    instrumentation = Instrumentation(sink, timer)
+    return instrumentation
+
+def uninstrument():
+    global instrumentation
+    instrumentation = None
+
+EXPRESSION = re.compile(r'{(-)?([^}]+)}')
+
+def parse(template):
+    """
+    Split a template into its segments: literal strings and Expression objects
+    """
+    segments = []
+    pos = 0
+    for match in EXPRESSION.finditer(template):
+        if match.start() > pos:
+            segments.append(template[pos:match.start()])
+        segments.append(parse_expression(*match.groups()))
+        pos = match.end()
+    if pos < len(template):
+        segments.append(template[pos:])
+    return segments
+
+def render(segments):
+    """
+    The text of a template from its segments
+    """
+    return ''.join([segment.render() if isinstance(segment, Expression) else segment for segment in segments])
+
+def parse_expression(is_operator, body):
     if is_operator: # leading '-'
-        operator, arg, operands = re.split(r'\|', body)
-        variables = re.split(',', operands)
-        return operators[operator](arg, variables, params, encoding, partial)
+        operator, arg, operands = body.split('|')
+        return Expression(operator, arg, tuple(operands.split(',')))
     else:
-        return operators['variable'](body, params, encoding, partial)
+        return Expression('variable', None, (body,))
+
+class Expression(object):
+    """
+    A parsed template expression, i.e. a {variable} or an {-operator|arg|variables}
+    """
+    __slots__ = ('operator', 'arg', 'variables', 'func')
+
+    def __init__(self, operator, arg, variables):
+        self.operator = operator
+        self.arg = arg
+        self.variables = variables
+        self.func = operators[operator]
+
+    def expand(self, params, encoding, partial):
+        if self.arg is None:
+            return self.func(self.variables[0], params, encoding, partial)
+        else:
+            return self.func(self.arg, self.variables, params, encoding, partial)
+
+    def variables_in(self, params):
+        for variable in self.variables:
+            if variable in params:
+                return True
+        return False
+
+    def bind(self, params, encoding):
+        """
+        Partial expansion without rendering: returns a list of segments (literal strings and Expression objects) to
+        replace this expression given params that include at least one of its variables
+        """
+        bound = bindings[self.operator](self.arg, self.variables, params, encoding)
+        return [self] if bound is None else bound
+
+    def render(self):
+        if self.operator == 'variable':
+            return '{%s}' % self.variables[0]
+        return '{-%s|%s|%s}' % (self.operator, self.arg, ','.join(self.variables))
+
+    def expand_column(self, columns, encoding, n):
+        """
+        Returns the list of n expansions of this expression for the rows of the given columns (see
+        Template.expand_columns()).  The single-variable operators work on whole columns; the others fall back to
+        expanding a row at a time.
+        """
+        operator = self.operator
+        if operator in ('variable', 'prefix', 'suffix'):
+            values = columns.get(single_variable(self.variables))
+            if values is None:
+                return [''] * n
+            encoded = encoding.column(values)
+            if operator == 'variable':
+                return [e if e is not None else '' for e in encoded]
+            elif operator == 'prefix':
+                arg = self.arg
+                return [arg + e if e is not None else '' for e in encoded]
+            else:
+                arg = self.arg
+                return [e + arg if e is not None else '' for e in encoded]
+        else:
+            names = [variable for variable in self.variables if variable in columns]
+            if not names:
+                return [self.expand({}, encoding, False)] * n
+            return [self.expand(dict((k, v) for k, v in itertools.izip(names, values) if v is not None), encoding, False)
+                    for values in itertools.izip(*[columns[name] for name in names])]
+
+class Template(object):
+    """
+    A compiled URI template, its literal text and expressions parsed once at construction time.  The literal prefix
+    (the whole template if it has no expressions) is kept apart from the tail of segments that expansion has to
+    work through.  A template can also be made from segments (see bind()), its text then rendered on first use.
+    """
+    __slots__ = ('_template', 'segments', 'variables', 'prefix', 'tail')
+
+    def __init__(self, template, segments=None, variables=None):
+        self._template = template
+        self.segments = parse(template) if segments is None else segments
+        if variables is None:
+            variables = frozenset(variable for segment in self.segments if isinstance(segment, Expression)
+                                           for variable in segment.variables)
+        self.variables = variables
+        if self.segments and not isinstance(self.segments[0], Expression):
+            self.prefix = self.segments[0]
+            self.tail = tuple(self.segments[1:])
+        else:
+            self.prefix = ''
+            self.tail = tuple(self.segments)
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = render(self.segments)
+        return self._template
+
+    @property
+    def static(self):
+        """
+        True if the template has no expressions, expanding to itself whatever the params
+        """
+        return not self.tail
+
+    def bind(self, params, encoding=urllib.quote):
+        """
+        Partial expansion without re-parsing: returns a Template in which the variables in params are bound, the
+        expressions they settle being reduced to literal text and the rest kept as expressions, its text rendered
+        only when asked for.  Expanding the result is equivalent to expanding compile(self.partial_expand(params)),
+        and its text is the same; returns this template itself if none of its variables are in params.
+        """
+        if self.variables.isdisjoint(params):
+            return self
+        segments = []
+        variables = set()
+        literal = '' # pending literal text, merged from adjacent literals and bound expressions
+        for segment in self.segments:
+            if segment.__class__ is not Expression:
+                literal += segment
+            elif not segment.variables_in(params):
+                if literal:
+                    segments.append(literal)
+                    literal = ''
+                segments.append(segment)
+                variables.update(segment.variables)
+            else:
+                for bound in segment.bind(params, encoding):
+                    if bound.__class__ is not Expression:
+                        literal += bound
+                    else:
+                        if literal:
+                            segments.append(literal)
+                            literal = ''
+                        segments.append(bound)
+                        variables.update(bound.variables)
+        if literal:
+            segments.append(literal)
+        return Template(None, segments, frozenset(variables))
+
+    def expand(self, params, encoding=urllib.quote):
+        """
+        Expand the template, omitting expressions whose variables aren't in params
+        """
+        return self._expand(params, encoding, False)
+
+    def partial_expand(self, params, encoding=urllib.quote):
+        """
+        Expand the template, leaving expressions whose variables aren't in params for later expansion
+        """
+        return self._expand(params, encoding, True)
+
+    def _expand(self, params, encoding, partial):
+        if not self.tail:
+            return self.prefix
+        return self.prefix + ''.join([segment.expand(params, encoding, partial) if isinstance(segment, Expression)
+                                      else segment for segment in self.tail])
+
+    def expand_columns(self, columns, encoding=urllib.quote, length=None):
+        """
+        Bulk expansion: returns the list of expansions of the template for each row of the given columns, a dict of
+        equal-length sequences (lists, tuples, NumPy arrays etc) of values keyed by variable name.  A None value means
+        that the variable is absent from that row, and numbers are converted to strings before encoding.  The
+        template is expanded a segment at a time across all the rows, and each distinct value is encoded only once.
+        The length of the columns must be given if there are none.
+        """
+        columns = dict((name, column_values(values)) for name, values in columns.iteritems())
+        lengths = set(len(values) for values in columns.itervalues())
+        if length is not None:
+            lengths.add(length)
+        if len(lengths) != 1:
+            raise ValueError('columns must be of equal length, given lengths %s' % sorted(lengths) if lengths
+                             else 'length must be given when there are no columns')
+        n = lengths.pop()
+
+        encode = MemoizedEncoding(encoding)
+        result = None
+        literal = ''
+        for segment in self.segments:
+            if isinstance(segment, Expression):
+                expanded = segment.expand_column(columns, encode, n)
+                if result is None:
+                    result = [literal + e for e in expanded] if literal else expanded
+                elif literal:
+                    result = [r + literal + e for r, e in itertools.izip(result, expanded)]
+                else:
+                    result = [r + e for r, e in itertools.izip(result, expanded)]
+                literal = ''
+            else:
+                literal += segment
+        if result is None:
+            return [literal] * n
+        elif literal:
+            return [r + literal for r in result]
+        else:
+            return result
+
+    def __str__(self):
+        return self.template
+
+    def __repr__(self):
+        return 'uri_template.compile(%r)' % self.template
 
 def single_variable(variables):
     if len(variables) != 1:
@@ -106,35 +636,7 @@ def op_join(separator, variables, params, encoding, partial):
     if not partial:
         return separator.join(variable + '=' + encoded_lookup(params, variable, encoding) for variable in variables if variable in params)
     else:
-        buf = ''
-        deferred = []
-        filled = False
-        for variable in variables:
-            if variable in params:
-                if deferred:
-                    if filled:
-                        if len(deferred) == 1:
-                            buf += '{-prefix|%s%s=|%s}' % (separator, deferred[0], deferred[0])
-                        else:
-                            buf += '{-opt|%s|%s}{-join|%s|%s}' % (separator, ','.join(deferred), separator, ','.join(deferred))
-                    else:
-                        buf += '{-join|%s|%s}{-opt|%s|%s}' % (separator, ','.join(deferred), separator, ','.join(deferred))
-                    deferred = []
-                if filled:
-                    buf += separator
-                buf += '%s=%s' % (variable, encoded_lookup(params, variable, encoding))
-                filled = True
-            else:
-                deferred.append(variable)
-        if deferred:
-            if filled:
-                if len(deferred) == 1:
-                    buf += '{-prefix|%s%s=|%s}' % (separator, deferred[0], deferred[0])
-                else:
-                    buf += '{-opt|%s|%s}{-join|%s|%s}' % (separator, ','.join(deferred), separator, ','.join(deferred))
-            else:
-                buf += '{-join|%s|%s}' % (separator, ','.join(deferred))
-        return buf
+        return render(bind_join(separator, variables, params, encoding))
 
 @operator('list')
 def op_list(separator, variables, params, encoding, partial):
@@ -144,7 +646,160 @@ def op_list(separator, variables, params, encoding, partial):
     elif partial:
         return '{-list|%s|%s}' % (separator, variable)
     else:
-        ''
+        return ''
+
+# Binding: partial expansion to segments rather than text (see Template.bind()).  Each operator's binding returns the
+# segments replacing its expression given params that include at least one of its variables, or None if the
+# expression is unaffected.
+
+bindings = {}
+
+def binding(name):
+    def save_binding(func):
+        bindings[name] = func
+        return func
+    return save_binding
+
+def present(variables, params):
+    for variable in variables:
+        if variable in params and params[variable] != []:
+            return True
+    return False
+
+@binding('variable')
+def bind_variable(arg, variables, params, encoding):
+    return [encoded_lookup(params, variables[0], encoding)]
+
+@binding('opt')
+def bind_opt(arg, variables, params, encoding):
+    if present(variables, params):
+        return [arg]
+
+@binding('neg')
+def bind_neg(arg, variables, params, encoding):
+    if present(variables, params):
+        return []
+
+@binding('prefix')
+def bind_prefix(prefix, variables, params, encoding):
+    return [prefix + encoded_lookup(params, single_variable(variables), encoding)]
+
+@binding('suffix')
+def bind_suffix(suffix, variables, params, encoding):
+    return [encoded_lookup(params, single_variable(variables), encoding) + suffix]
+
+@binding('join')
+def bind_join(separator, variables, params, encoding):
+    segments = []
+    deferred = []
+    filled = False
+    for variable in variables:
+        if variable in params:
+            if deferred:
+                segments.extend(deferred_join(separator, tuple(deferred), filled, False))
+                deferred = []
+            if filled:
+                segments.append(separator)
+            segments.append(variable + '=' + encoded_lookup(params, variable, encoding))
+            filled = True
+        else:
+            deferred.append(variable)
+    if deferred:
+        segments.extend(deferred_join(separator, tuple(deferred), filled, True))
+    return segments
+
+def deferred_join(separator, deferred, filled, last):
+    """
+    Expressions for a run of unbound -join variables, given whether bound ones precede them and whether any follow
+    """
+    if filled:
+        if len(deferred) == 1:
+            return [Expression('prefix', separator + deferred[0] + '=', deferred)]
+        return [Expression('opt', separator, deferred), Expression('join', separator, deferred)]
+    elif last:
+        return [Expression('join', separator, deferred)]
+    else:
+        return [Expression('join', separator, deferred), Expression('opt', separator, deferred)]
+
+@binding('list')
+def bind_list(separator, variables, params, encoding):
+    return [separator.join(map(encoding, params[single_variable(variables)]))]
+
+# Reverse matching: regexes recognising what each operator expands to.  Values never span a '/', and each capture is
+# recorded as a (variable, separator) pair, the separator being that of a list-valued capture or None.
+
+patterns = {}
+
+def pattern(name):
+    def save_pattern(func):
+        patterns[name] = func
+        return func
+    return save_pattern
+
+VALUE = r'([^/]+?)'
+
+@pattern('variable')
+def pattern_variable(variable):
+    return VALUE, [(variable, None)]
+
+@pattern('opt')
+def pattern_opt(arg, variables):
+    return '(?:%s)?' % re.escape(arg), []
+
+@pattern('neg')
+def pattern_neg(arg, variables):
+    return '(?:%s)?' % re.escape(arg), []
+
+@pattern('prefix')
+def pattern_prefix(prefix, variables):
+    return '(?:%s%s)?' % (re.escape(prefix), VALUE), [(single_variable(variables), None)]
+
+@pattern('suffix')
+def pattern_suffix(suffix, variables):
+    return '(?:%s%s)?' % (VALUE, re.escape(suffix)), [(single_variable(variables), None)]
+
+@pattern('join')
+def pattern_join(separator, variables):
+    sources = []
+    for i, variable in enumerate(variables):
+        sources.append('(?:%s%s=%s)?' % ('(?:%s)?' % re.escape(separator) if i else '', re.escape(variable), VALUE))
+    return ''.join(sources), [(variable, None) for variable in variables]
+
+@pattern('list')
+def pattern_list(separator, variables):
+    return '(%s(?:%s%s)*)?' % (VALUE[1:-1], re.escape(separator), VALUE[1:-1]), [(single_variable(variables), separator)]
+
+def regex_source(segments):
+    """
+    Returns a regex source matching what the given template segments expand to, with the list of (variable, separator)
+    pairs captured by its groups, in order
+    """
+    sources = []
+    captures = []
+    for segment in segments:
+        if isinstance(segment, Expression):
+            if segment.arg is None:
+                source, captured = patterns[segment.operator](segment.variables[0])
+            else:
+                source, captured = patterns[segment.operator](segment.arg, segment.variables)
+            sources.append(source)
+            captures.extend(captured)
+        else:
+            sources.append(re.escape(segment))
+    return ''.join(sources), captures
+
+def captured_params(captures, groups, decoding=urllib.unquote):
+    """
+    Returns a params dict from the groups of a match against a regex_source() regex
+    """
+    params = {}
+    for (variable, separator), value in zip(captures, groups):
+        if value is not None:
+            if separator is None:
+                params[variable] = decoding(value)
+            else:
+                params[variable] = map(decoding, value.split(separator)) if separator else [decoding(value)]
+    return params
 
 if __name__ == '__main__':
     import unittest
@@ -227,4 +882,132 @@ if __name__ == '__main__':
                 self.assertEqual(expected, sub(sub(t, {}, partial=True), params), "testing (1) " + repr(params))
                 self.assertEqual(expected, sub(sub(t, params, partial=True), {}), "testing (2) " + repr(params))
 
+        def test_bind(self):
+            for template, params, expected in testdata:
+                self.assertEqual(expected, compile(template).bind(params).expand({}), "testing " + repr(template))
+            compiled = compile(t)
+            for params in test_partial_params:
+                bound = compiled.bind(params)
+                self.assertEqual(sub(t, params, partial=True), bound.template, "testing " + repr(params))
+                for other in test_partial_params:
+                    combined = dict(other, **params)
+                    self.assertEqual(sub(t, combined), bound.bind(other).expand({}), "testing " + repr(combined))
+            self.assertTrue(compiled.bind({'unused': 'x'}) is compiled)
+            bound = compile('/users/{user_id}/articles{-prefix|.|format}').bind({'user_id': 'dojo'})
+            self.assertEqual(('/users/dojo/articles', 1), (bound.prefix, len(bound.tail)))
+
+        def test_cache(self):
+            c = LRUCache(2)
+            c['a'] = 1
+            c['b'] = 2
+            self.assertEqual(1, c.get('a'))
+            c['c'] = 3
+            self.assertEqual(None, c.get('b'))
+            self.assertEqual(CacheInfo(1, 1, 1, 2, 2), c.info())
+
+        def test_cache_ttl(self):
+            now = [0]
+            c = LRUCache(ttl=10, timer=lambda: now[0])
+            c['a'] = 1
+            now[0] = 5
+            self.assertEqual(1, c.get('a'))
+            now[0] = 10
+            self.assertEqual(None, c.get('a'))
+            self.assertEqual(CacheInfo(1, 1, 1, None, 0), c.info())
+
+        def test_cached(self):
+            clear_cache()
+            sub('/path/to/{foo}', {'foo': 'a'})
+            sub('/path/to/{foo}', {'foo': 'b'})
+            self.assertTrue(cached('/path/to/{foo}') is cached('/path/to/{foo}'))
+            info = cache_info()
+            self.assertEqual((3, 1), (info.hits, info.misses))
+
+        def test_regex_source(self):
+            for template, params in [
+                    ('/users/{user_id}{-prefix|.|format}', {'user_id': 'dojo', 'format': 'json'}),
+                    ('/users/{user_id}{-prefix|.|format}', {'user_id': 'dojo'}),
+                    ('/search{-opt|?|q,num}{-join|&|q,num}', {'q': 'a b', 'num': '10'}),
+                    ('/search{-opt|?|q,num}{-join|&|q,num}', {'num': '10'}),
+                    ('/path/to/{-list|/|foo}', {'foo': ['a', 'b', 'c']}),
+                    ('/path/to/{-suffix|/|foo}', {'foo': 'barney'})]:
+                source, captures = regex_source(compile(template).segments)
+                match = re.match(source + '$', sub(template, params))
+                self.assertEqual(params, captured_params(captures, match.groups()), "testing " + repr((template, params)))
+
+        def test_variables(self):
+            self.assertEqual(frozenset(['foo', 'bar', 'baz', 'foo=def']), compile(t).variables)
+            self.assertEqual(frozenset(), compile('/path/to').variables)
+
+        def test_expand_columns(self):
+            rows = [{'foo': 'barney', 'bar': 'a b', 'parts': ['x', 'y']}, {'foo': 'wilma', 'parts': []}, {'bar': 'c'}, {}]
+            for template in [
+                    '/path/to/{foo}/{bar}', '{-prefix|/|foo}{-suffix|/|bar}x', '/{-opt|opt|foo,bar}{-neg|neg|foo}',
+                    '?{-join|&|foo,bar}', '/{-list|/|parts}.json', '/literal']:
+                columns = {'foo': ['barney', 'wilma', None, None], 'bar': ['a b', None, 'c', None],
+                           'parts': [['x', 'y'], [], None, None]}
+                self.assertEqual([sub(template, row) for row in rows], compile(template).expand_columns(columns),
+                                 "testing " + repr(template))
+            self.assertEqual(['/users/1', '/users/22'], compile('/users/{id}').expand_columns({'id': xrange(1, 23, 21)}))
+            self.assertEqual(['/', '/'], compile('/').expand_columns({}, length=2))
+            self.assertRaises(ValueError, compile('/{a}{b}').expand_columns, {'a': [1], 'b': [1, 2]})
+
+        def test_quoter(self):
+            quote = quoter()
+            for value in ['dojo', 'a-b_c.d/e', 'a b', 'dojo', '&', 'a b', '|', u'caf\xe9'.encode('utf-8'), '']:
+                self.assertEqual(urllib.quote(value), quote(value), "testing " + repr(value))
+            self.assertEqual(QuoterInfo(2, 7, 3, 0, 10000, 7), quote.info())
+            quote = quoter(maxsize=1)
+            quote('a')
+            quote('b')
+            self.assertEqual(QuoterInfo(0, 2, 2, 1, 1, 1), quote.info())
+            quote = quoter(maxsize=0)
+            self.assertEqual(['a', 'a'], [quote('a'), quote('a')])
+            self.assertEqual(QuoterInfo(0, 2, 2, 0, 0, 0), quote.info())
+            quote.clear()
+            self.assertEqual(QuoterInfo(0, 0, 0, 0, 0, 0), quote.info())
+            encode = MemoizedEncoding(urllib.quote, 2)
+            self.assertEqual(['1', 'a%20b', '1', None, 'c'], encode.column([1, 'a b', 1, None, 'c']))
+            self.assertEqual(CacheInfo(2, 3, 1, 2, 2), encode.info())
+            self.assertEqual(['1', '1.0', 'True'], MemoizedEncoding(urllib.quote).column([1, 1.0, True]))
+            q = quoter()
+            self.assertEqual(['1', '1.0'], [q(1), q(1.0)])
+            self.assertEqual(['/1', '/1.0'], compile('/{x}').expand_columns({'x': [1, 1.0]}))
+            self.assertEqual('/path/to/%26&%26&%7C&_', sub('/path/to/{-list|&|foo}', {'foo': ['&', '&', '|', '_']}, quote))
+
+        def test_instrumentation(self):
+            calls = []
+            instrumentation = instrument(lambda *args: calls.append(args), timer=itertools.count().next)
+            try:
+                sub('/users/{user_id}', {'user_id': 'dojo'})
+                sub('/users/{user_id}', {'user_id': 'dojo'})
+            finally:
+                uninstrument()
+            sub('/users/{user_id}', {'user_id': 'dojo'})
+            self.assertEqual([('sub', '/users/{user_id}', 1, None)] * 2, calls)
+            stats = instrumentation.report()[('sub', '/users/{user_id}')]
+            self.assertEqual((2, 2, 1, 0), stats[:4])
+            self.assertEqual(2, stats.histogram[list(Instrumentation.BUCKETS).index(1.0)])
+            self.assertEqual([(('sub', '/users/{user_id}'), stats)], instrumentation.most_called(operation='sub'))
+
+        def test_static(self):
+            static = compile('/users/new')
+            self.assertTrue(static.static)
+            self.assertEqual('/users/new', static.expand({'user_id': 'dojo'}))
+            template = compile('/users/{user_id}/edit{-prefix|.|format}')
+            self.assertFalse(template.static)
+            self.assertEqual(('/users/', 3), (template.prefix, len(template.tail)))
+            self.assertEqual(('', 1), (compile('{user_id}').prefix, len(compile('{user_id}').tail)))
+
+        def test_compile(self):
+            for template, params, expected in testdata:
+                self.assertEqual(expected, compile(template).expand(params), " ".join(["testing", repr(template), repr(params)]))
+
+        def test_compiled_partial(self):
+            compiled = compile(t)
+            for params in test_partial_params:
+                expected = sub(t, params)
+                self.assertEqual(sub(t, params, partial=True), compiled.partial_expand(params), "testing " + repr(params))
+                self.assertEqual(expected, compile(compiled.partial_expand({})).expand(params), "testing " + repr(params))
+
     unittest.main()